@@ -1,15 +1,321 @@
-from flask import Flask, request, abort, jsonify
+import json
+import os
+import compression
+import metrics
+import querylog
+from flask import Flask, current_app, g, request, abort
 from flask_cors import CORS
-from models import setup_db, Actor, Movie
-from auth import AuthError, requires_auth
+from sqlalchemy import orm
+from sqlalchemy.orm import selectinload
+from models import (setup_db, db, cast_of, delete_by_id, insert_many, link,
+                    load_fields, model_fields, read_rows, row_count,
+                    mark_write, seed_row_counts, seed_table_versions,
+                    select_rows, starts_with, unlink, update_by_id,
+                    use_replica, Actor, GroupCommitWriter, Movie, RowCount,
+                    TableVersion, BULK_BATCH_SIZE, GROUP_COMMIT)
+from auth import AuthError, check_permissions, jwks_store, requires_auth
+from cache import cached
+from conditional import conditional, included
+from querylog import query_budget
+from search import create_search_index, search
+from serializers import json_response, parse_datetime, serializer
+from streaming import NDJSON_MIMETYPE, stream_list, wants_stream
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 10000))
+BULK_MAX_BYTES = int(os.environ.get('BULK_MAX_BYTES', 10 * 1024 * 1024))
+
+ACTOR_FIELDS = ('name', 'age', 'gender')
+MOVIE_FIELDS = ('title',)
+
+# ?include= values of the list endpoints
+ACTOR_INCLUDES = {'movies': Actor.actor_in_movies}
+MOVIE_INCLUDES = {'actors': Movie.movies_actors}
+
+
+'''
+get_page_args()
+...reads the keyset pagination parameters of a list request
+
+    limit: page size, capped at MAX_PAGE_SIZE
+    after: id of the last row of the previous page (the next_cursor)
+    include_total: total count is only computed when asked for
+'''
+
+
+def get_page_args():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        abort(400)
+    if limit < 1 or after < 0:
+        abort(400)
+    include_total = request.args.get('include_total', '').lower() in (
+        '1', 'true', 'yes')
+    return min(limit, MAX_PAGE_SIZE), after, include_total
+
+
+'''
+keyset_page(model, after, limit)
+...returns the rows with id > after matching filters in id order, and the
+cursor of the next page (None on the last page)
+runs WHERE id > :after ORDER BY id LIMIT :limit + 1 on the primary key
+index, so every page costs the same however deep it is
+fields are the columns to select (see get_fields()), read as plain rows,
+unless options (the eager loads of get_includes()) need model instances
+'''
+
+
+def keyset_page(model, after, limit, filters=(), options=(), fields=None):
+    fields = fields or model_fields(model)
+    if options:
+        rows = load_fields(model, fields, options).filter(
+            model.id > after, *filters).order_by(model.id).limit(
+            limit + 1).all()
+    else:
+        rows = read_rows(select_rows(model, fields, model.id > after,
+                                     *filters).limit(limit + 1)).fetchall()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+'''
+actor_filters() / movie_filters()
+...translate the filter query parameters of a list request into SQL
+conditions, each one backed by an index (see models.py)
+
+    actors: name (prefix), gender, age_min, age_max (inclusive)
+    movies: released_after (inclusive), released_before (exclusive),
+    as ISO 8601 dates or date-times
+'''
+
+
+def get_arg(name, convert):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        abort(400)
+
+
+def actor_filters():
+    filters = []
+    name = request.args.get('name')
+    if name:
+        filters.append(starts_with(Actor.name, name))
+    gender = request.args.get('gender')
+    if gender:
+        filters.append(Actor.gender == gender)
+    age_min = get_arg('age_min', int)
+    if age_min is not None:
+        filters.append(Actor.age >= age_min)
+    age_max = get_arg('age_max', int)
+    if age_max is not None:
+        filters.append(Actor.age <= age_max)
+    return filters
+
+
+def movie_filters():
+    filters = []
+    released_after = get_arg('released_after', parse_datetime)
+    if released_after is not None:
+        filters.append(Movie.release_date >= released_after)
+    released_before = get_arg('released_before', parse_datetime)
+    if released_before is not None:
+        filters.append(Movie.release_date < released_before)
+    return filters
+
+
+'''
+get_fields(model)
+...reads the sparse fieldset of a list or detail request, ?fields=id,name,
+as the column names to select, always with id (the pagination key)
+returns every column without the parameter
+aborts with 400 for a name that is not a column of model
+'''
+
+
+def get_fields(model):
+    columns = model_fields(model)
+    value = request.args.get('fields')
+    if value is None:
+        return columns
+    names = set(name.strip() for name in value.split(',') if name.strip())
+    if not names or not names.issubset(columns):
+        abort(400)
+    names.add('id')
+    return [column for column in columns if column in names]
+
+
+'''
+get_includes(related)
+...reads the include parameter of a list request and returns the names
+and the eager loads of the included relationships
+each relationship is loaded with one SELECT ... WHERE id IN (...) for the
+whole page, so the number of queries does not grow with the page size
+aborts with 400 for an unknown name or together with streaming
+'''
+
+
+def get_includes(related):
+    includes = included(related)
+    if includes and wants_stream():
+        abort(400)
+    return includes, [selectinload(relationship)
+                      for _, relationship in includes]
+
+
+def format_with(serialize, row, includes):
+    result = serialize(row)
+    for name, relationship in includes:
+        serialize_other = serializer(relationship.property.mapper.class_)
+        result[name] = [serialize_other(other)
+                        for other in getattr(row, relationship.key)]
+    return result
+
+
+def get_or_404(model, id):
+    if model.query.with_entities(model.id).filter(
+            model.id == id).first() is None:
+        abort(404)
+
+
+'''
+missing_fields(body, fields)
+...returns the required fields that are missing or empty in a request body
+'''
+
+
+def missing_fields(body, fields):
+    if not isinstance(body, dict):
+        return list(fields)
+    return [field for field in fields
+            if body.get(field) is None or body.get(field) == '']
+
+
+'''
+get_bulk_rows()
+...reads the body of a bulk request, either a JSON array or NDJSON (one
+object per line), and returns a list of (index, row or None)
+NDJSON lines that are not valid JSON are returned as None
+
+aborts with 413 above BULK_MAX_BYTES or BULK_MAX_ROWS rows, and with 400
+when the body is not UTF-8 or a JSON body is not an array
+'''
+
+
+def get_bulk_rows():
+    if request.content_length is not None and \
+            request.content_length > BULK_MAX_BYTES:
+        abort(413)
+    data = request.stream.read(BULK_MAX_BYTES + 1)
+    if len(data) > BULK_MAX_BYTES:
+        abort(413)
+
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        abort(400)
+
+    if request.mimetype == NDJSON_MIMETYPE:
+        rows = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)
+    else:
+        try:
+            rows = json.loads(text)
+        except ValueError:
+            abort(400)
+        if not isinstance(rows, list):
+            abort(400)
 
+    if len(rows) > BULK_MAX_ROWS:
+        abort(413)
+    return list(enumerate(rows))
+
+
+'''
+bulk_create(model, fields)
+...validates every row of a bulk request with the rules of the single row
+endpoint, inserts the valid ones in one transaction and returns the
+created ids together with the errors of the rejected rows
+
+bulk_budget() is the query budget of the bulk routes: 2 statements, and 3
+per batch of BULK_BATCH_SIZE rows (insert, id read-back, search index)
+'''
+
+
+def bulk_create(model, fields):
+    values, errors = [], []
+    for index, row in get_bulk_rows():
+        if row is None:
+            errors.append({"index": index, "message": "invalid JSON"})
+            continue
+        missing = missing_fields(row, fields)
+        if missing:
+            errors.append({"index": index,
+                           "message": "missing or empty fields",
+                           "fields": missing})
+            continue
+        values.append({field: row[field] for field in fields})
+    g.bulk_rows = len(values)
+    try:
+        created = insert_many(model, values)
+    except Exception:
+        abort(422)
+    return json_response({
+        "success": True,
+        "created": created,
+        "errors": errors
+    })
+
+
+def bulk_budget():
+    batches = -(-g.get('bulk_rows', 0) // BULK_BATCH_SIZE)
+    return 2 + 3 * batches
+
+
+'''
+insert_one(model, values)
+...inserts one row and returns its id, through the group commit writer
+of the app when there is one
+'''
+
+
+def insert_one(model, values):
+    writer = current_app.extensions.get('group_commit')
+    if writer is None:
+        row = model(**values)
+        row.insert()
+        return row.id
+    mark_write()
+    return writer.insert(model, values)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is None:
+        setup_db(app)
+    else:
+        app.config.update(test_config)
+        setup_db(app, app.config['SQLALCHEMY_DATABASE_URI'],
+                 app.config.get('DATABASE_REPLICA_URLS', []))
+    if app.config.get('GROUP_COMMIT', GROUP_COMMIT):
+        app.extensions['group_commit'] = GroupCommitWriter(app)
     CORS(app)
+    metrics.init_app(app)
+    querylog.init_app(app)
+    compression.init_app(app)
 
     # actor = Actor(name='ak', age=156, gender='sasaa')
     # movie = Movie(title='titanic2')
@@ -17,21 +323,38 @@ def create_app(test_config=None):
     # db.session.add(actor)
     # db.session.commit()
     @app.route('/')
+    @query_budget(0)
     def index():
-        return jsonify({'message': 'Udacity Capestone Project'}
-                       )
+        return json_response({'message': 'Udacity Capestone Project'})
     #########################
     # Get Actors
     #########################
     @app.route('/actors', methods=['GET'])
+    # worst case: 2 table versions, page, included rows, total
+    @query_budget(5)
     @requires_auth('get:actors')
+    @use_replica
+    @conditional(Actor, ACTOR_INCLUDES)
+    @cached(Actor, ACTOR_INCLUDES)
     def get_actors(token):
+        limit, after, include_total = get_page_args()
+        filters = actor_filters()
+        fields = get_fields(Actor)
+        includes, options = get_includes(ACTOR_INCLUDES)
+        if wants_stream():
+            return stream_list(Actor, 'actors', after, filters, fields)
         try:
-            actors_details = list(map(Actor.format, Actor.query.all()))
-            return jsonify({"success": True,
-                            "actors": actors_details,
-                            "total_actors": len(Actor.query.all()),
-                            }), 200
+            actors, next_cursor = keyset_page(Actor, after, limit, filters,
+                                              options, fields)
+            serialize = serializer(Actor, fields)
+            result = {"success": True,
+                      "actors": [format_with(serialize, actor, includes)
+                                 for actor in actors],
+                      "next_cursor": next_cursor,
+                      }
+            if include_total:
+                result["total_actors"] = row_count(Actor)
+            return json_response(result)
         except Exception:
             abort(404)
 
@@ -39,81 +362,232 @@ def create_app(test_config=None):
     # Get Movies
     ##########################
     @app.route('/movies', methods=['GET'])
+    # worst case: 2 table versions, page, included rows, total
+    @query_budget(5)
     @requires_auth('get:movies')
+    @use_replica
+    @conditional(Movie, MOVIE_INCLUDES)
+    @cached(Movie, MOVIE_INCLUDES)
     def get_movies(token):
+        limit, after, include_total = get_page_args()
+        filters = movie_filters()
+        fields = get_fields(Movie)
+        includes, options = get_includes(MOVIE_INCLUDES)
+        if wants_stream():
+            return stream_list(Movie, 'movies', after, filters, fields)
+        try:
+            movies, next_cursor = keyset_page(Movie, after, limit, filters,
+                                              options, fields)
+            serialize = serializer(Movie, fields)
+            result = {"success": True,
+                      "movies": [format_with(serialize, movie, includes)
+                                 for movie in movies],
+                      "next_cursor": next_cursor,
+                      }
+            if include_total:
+                result["total_movies"] = row_count(Movie)
+            return json_response(result)
+        except Exception:
+            abort(404)
+
+    ##########################
+    # Get one actor / movie
+    ##########################
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @query_budget(2)
+    @requires_auth('get:actors')
+    @use_replica
+    @conditional(Actor)
+    @cached(Actor)
+    def get_actor(token, actor_id):
+        fields = get_fields(Actor)
+        actor = read_rows(select_rows(
+            Actor, fields, Actor.id == actor_id)).first()
+        if actor is None:
+            abort(404)
+        return json_response({
+            "success": True,
+            "actor": serializer(Actor, fields)(actor)
+        })
+
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @query_budget(2)
+    @requires_auth('get:movies')
+    @use_replica
+    @conditional(Movie)
+    @cached(Movie)
+    def get_movie(token, movie_id):
+        fields = get_fields(Movie)
+        movie = read_rows(select_rows(
+            Movie, fields, Movie.id == movie_id)).first()
+        if movie is None:
+            abort(404)
+        return json_response({
+            "success": True,
+            "movie": serializer(Movie, fields)(movie)
+        })
+
+    ##########################
+    # Cast of a movie / movies of an actor
+    ##########################
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @query_budget(4)
+    @requires_auth('get:actors')
+    @use_replica
+    @conditional(Actor, parent=Movie)
+    @cached(Actor, parent=Movie)
+    def get_movie_actors(token, movie_id):
+        limit, after = get_page_args()[:2]
+        fields = get_fields(Actor)
+        get_or_404(Movie, movie_id)
+        actors, next_cursor = keyset_page(Actor, after, limit,
+                                          [cast_of(Movie, movie_id)],
+                                          fields=fields)
+        return json_response({
+            "success": True,
+            "actors": [serializer(Actor, fields)(actor) for actor in actors],
+            "next_cursor": next_cursor
+        })
+
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @query_budget(4)
+    @requires_auth('get:movies')
+    @use_replica
+    @conditional(Movie, parent=Actor)
+    @cached(Movie, parent=Actor)
+    def get_actor_movies(token, actor_id):
+        limit, after = get_page_args()[:2]
+        fields = get_fields(Movie)
+        get_or_404(Actor, actor_id)
+        movies, next_cursor = keyset_page(Movie, after, limit,
+                                          [cast_of(Actor, actor_id)],
+                                          fields=fields)
+        return json_response({
+            "success": True,
+            "movies": [serializer(Movie, fields)(movie) for movie in movies],
+            "next_cursor": next_cursor
+        })
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @query_budget(6)
+    @requires_auth('patch:movies')
+    def add_movie_actor(token, movie_id):
+        body = request.get_json()
+        # bool is an int subclass: true must not cast actor 1
+        if missing_fields(body, ('actor_id',)) or \
+                type(body['actor_id']) is not int:
+            abort(400)
         try:
-            movies_details = list(map(Movie.format, Movie.query.all()))
-            return jsonify({"success": True,
-                            "movies": movies_details,
-                            "total_movies": len(Movie.query.all())
-                            }), 200
+            linked = link(body['actor_id'], movie_id)
         except Exception:
+            abort(422)
+        if not linked:
             abort(404)
+        return json_response({
+            "success": True,
+            "movie": movie_id,
+            "actor": body['actor_id']
+        })
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['DELETE'])
+    @query_budget(3)
+    @requires_auth('patch:movies')
+    def remove_movie_actor(token, movie_id, actor_id):
+        try:
+            unlinked = unlink(actor_id, movie_id)
+        except Exception:
+            abort(422)
+        if not unlinked:
+            abort(404)
+        return json_response({
+            "success": True,
+            "movie": movie_id,
+            "actor": actor_id
+        })
+
+    ##########################
+    # Search actors and movies
+    ##########################
+    @app.route('/search', methods=['GET'])
+    @query_budget(3)
+    @requires_auth('get:actors')
+    @use_replica
+    def search_catalog(token):
+        check_permissions('get:movies', token)
+        q = request.args.get('q', '').strip()
+        if not q:
+            abort(400)
+        limit = get_page_args()[0]
+        offset = get_arg('offset', int) or 0
+        if offset < 0:
+            abort(400)
+
+        hits = search(q, limit + 1, offset)
+        return json_response({
+            "success": True,
+            "results": [{"type": kind, "score": score, kind: row}
+                        for kind, score, row in hits[:limit]],
+            "next_offset": offset + limit if len(hits) > limit else None
+        })
 
     ############################
     # Delete Actor
     ############################
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
+    @query_budget(7)
     @requires_auth('delete:actors')
     def delete_actor(token, actor_id):
         try:
-
-            actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-            if actor is None:
-                abort(404)
-
-            actor.delete()
-            return jsonify({
-                "success": True,
-                "message": "this actor id deleted",
-                "delete": actor_id,
-                "total_actors": len(Actor.query.all())
-            }), 200
+            deleted = delete_by_id(Actor, actor_id)
         except Exception:
             abort(422)
+        if not deleted:
+            abort(404)
+        return json_response({
+            "success": True,
+            "message": "this actor id deleted",
+            "delete": actor_id,
+            "total_actors": row_count(Actor)
+        })
     #########################
     # Delete movie
     #########################
 
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
+    @query_budget(7)
     @requires_auth('delete:movies')
     def delete_movie(token, movie_id):
         try:
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-            if movie is None:
-                abort(404)
-
-            movie.delete()
-            return jsonify({
-                "success": True,
-                "message": "this movie id deleted",
-                "delete": movie_id,
-                "total_movies": len(Movie.query.all())
-            }), 200
+            deleted = delete_by_id(Movie, movie_id)
         except Exception:
             abort(422)
+        if not deleted:
+            abort(404)
+        return json_response({
+            "success": True,
+            "message": "this movie id deleted",
+            "delete": movie_id,
+            "total_movies": row_count(Movie)
+        })
 
     ########################
     # Post actor
     ########################
     @app.route('/actors', methods=['POST'])
+    @query_budget(5)
     @requires_auth('post:actors')
     def create_actor(token):
         body = request.get_json()
-        new_name = body.get('name', None)
-        new_age = body.get('age', None)
-        new_gender = body.get('gender', None)
-
-        if any(arg is None for arg in [new_name, new_age, new_gender]
-               )or'' in[new_name, new_age, new_gender]:
+        if missing_fields(body, ACTOR_FIELDS):
             abort(400)
         try:
-            new_actor = Actor(name=new_name, age=new_age, gender=new_gender)
-            new_actor.insert()
-            return jsonify({
+            created = insert_one(Actor, {field: body[field]
+                                         for field in ACTOR_FIELDS})
+            return json_response({
                 "success": True,
-                "created": new_actor.id
-            }), 200
+                "created": created
+            })
         except Exception:
             abort(422)
     #########################
@@ -121,23 +595,36 @@ def create_app(test_config=None):
     ########################
 
     @app.route('/movies', methods=['POST'])
+    @query_budget(5)
     @requires_auth('post:movies')
     def create_movie(token):
         body = request.get_json()
-        new_title = body.get('title', None)
-
-        if any(arg is None for arg in [new_title])or'' in[new_title]:
+        if missing_fields(body, MOVIE_FIELDS):
             abort(400)
         try:
-            new_movie = Movie(title=new_title)
-            new_movie.insert()
-            return jsonify({
+            created = insert_one(Movie, {'title': body['title']})
+            return json_response({
                 "success": True,
-                "created": new_movie.id
-            }), 200
+                "created": created
+            })
         except Exception:
             abort(422)
 
+    ########################
+    # Bulk post actors / movies
+    ########################
+    @app.route('/actors/bulk', methods=['POST'])
+    @query_budget(bulk_budget)
+    @requires_auth('post:actors')
+    def create_actors_bulk(token):
+        return bulk_create(Actor, ACTOR_FIELDS)
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @query_budget(bulk_budget)
+    @requires_auth('post:movies')
+    def create_movies_bulk(token):
+        return bulk_create(Movie, MOVIE_FIELDS)
+
     ##########################
     # PATCH actor
     ##########################
@@ -170,115 +657,145 @@ def create_app(test_config=None):
     #     except Exception:
     #         abort(401)
     @app.route('/actors/<int:id>', methods=['PATCH'])
+    @query_budget(4)
     @requires_auth('patch:actors')
     def patch_actor(jwt, id):
-        actor = Actor.query.filter(Actor.id == id).one_or_none()
-        print('Actor ', actor)
-        if actor is None:
-            print('returning 404')
-            abort(404)
         data = request.get_json()
-        print('data ', data)
-        name = data.get('name')
-        age = data.get('age')
-        gender = data.get('gender')
+        if not isinstance(data, dict):
+            abort(400)
+        values = {field: data[field] for field in ACTOR_FIELDS
+                  if field in data}
+        if not values or missing_fields(values, tuple(values)):
+            abort(400)
         try:
-            actor.name = name
-            actor.age = age
-            actor.gender = gender
-            print('inside try block')
-            actor.update()
+            actor = update_by_id(Actor, id, values)
         except Exception:
-            print('update actor failed with 422')
             abort(422)
-        actors = Actor.query.all()
-        try:
-            print('Get all actors')
-            actors = [actor.format() for actor in actors]
-            return jsonify({
-                'success': True,
-                'actors': actors
-            }), 200
-        except Exception:
-            print('got exception 500')
-            abort(500)
+        if actor is None:
+            abort(404)
+        return json_response({
+            'success': True,
+            'actors': [serializer(Actor)(actor)]
+        })
 
     ##########################
     # PATCH movie
     ##########################
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+    @query_budget(4)
     @requires_auth('patch:movies')
     def edit_movie(token, movie_id):
         body = request.get_json()
-        new_title = body.get('title', None)
-        new_release_date = body.get('release_date', None)
+        if missing_fields(body, MOVIE_FIELDS):
+            abort(400)
+        values = {'title': body['title']}
+        if 'release_date' in body:
+            values['release_date'] = body['release_date']
 
         try:
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-            if movie is None:
-                abort(404)
-            if any(arg is None for arg in [new_title])or'' in[new_title]:
-                abort(400)
-
-            movie.title = new_title
-            movie.release_date = new_release_date
-
-            movie.update()
-            return jsonify({
-                "success": True,
-                "movie": [Movie.query.get(movie_id).format()]
-            }), 200
-
+            movie = update_by_id(Movie, movie_id, values)
         except Exception:
-            abort(401)
+            abort(422)
+        if movie is None:
+            abort(404)
+        return json_response({
+            "success": True,
+            "movie": [serializer(Movie)(movie)]
+        })
 
     #########################
     # Error Handling
     #########################
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 422,
             "message": "unprocessable"
-        }), 422
+        }, 422)
 
     @app.errorhandler(404)
     def not_found(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 404,
             "message": "Resource not found"
-        }), 404
+        }, 404)
 
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 400,
             "message": "Bad request"
-        }), 400
+        }, 400)
+
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return json_response({
+            "success": False,
+            "error": 413,
+            "message": "Payload too large"
+        }, 413)
 
     @app.errorhandler(401)
     def Unauthorized_error(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 401,
             "message": "Unauthorized Error"
-        }), 401
+        }, 401)
 
     @app.errorhandler(AuthError)
     def handle_auth_error(ex):
-        response = jsonify(ex.error)
-        response.status_code = ex.status_code
-        return response
+        return json_response(ex.error, ex.status_code)
 
     return app
 
 
-app = create_app()
+'''
+create_schema(app)
+...creates the missing tables and the search index and seeds the row
+counts and table versions; safe to run again, e.g. after db upgrade
+
+warm_up(app)
+...does the work of the first requests ahead of time: configures the
+mappers, compiles the read statements (filling the type processor caches
+of the dialect), builds the serializers and loads the signing keys.
+gunicorn.conf.py runs it in the master when the app is preloaded, so
+every forked worker starts with it done.
+'''
+
+
+def create_schema(app):
+    with app.app_context():
+        # the primary only: replicas get the tables by replication
+        db.create_all(bind=None)
+        seed_row_counts()
+        seed_table_versions()
+        create_search_index()
+
+
+def warm_up(app):
+    orm.configure_mappers()
+    with app.app_context():
+        dialect = db.engine.dialect
+        for model in (Actor, Movie):
+            fields = model_fields(model)
+            select_rows(model, fields).compile(dialect=dialect)
+            select_rows(model, fields, model.id == 0).compile(
+                dialect=dialect)
+            serializer(model)
+        for model in (RowCount, TableVersion):
+            model.query.filter(model.table_name == '').statement.compile(
+                dialect=dialect)
+    try:
+        jwks_store.refresh()
+    except AuthError:
+        # the workers fetch the keys on their first request instead
+        pass
 
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
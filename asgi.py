@@ -0,0 +1,280 @@
+import asyncio
+import io
+import re
+from collections import namedtuple
+from flask import Response, abort, request
+from sqlalchemy import select
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from werkzeug.exceptions import HTTPException
+import asyncdb
+from app import (actor_filters, create_app, get_fields, get_page_args,
+                 movie_filters, ACTOR_INCLUDES, MOVIE_INCLUDES)
+from auth import (AuthError, check_permissions, get_token_auth_header,
+                  token_cache, verify_decode_jwt)
+from cache import (cache_entry, cached_response, make_key, request_variant,
+                   response_cache)
+from compression import compress
+from conditional import etag_variant, format_etag, included
+from models import (db, row_count, select_rows, table_version, Actor, Movie,
+                    RowCount, TableVersion)
+from serializers import json_response, serializer
+from streaming import wants_stream
+
+'''
+ASGI entry point
+
+    uvicorn asgi:app --workers 4
+
+Serves GET /actors, /movies, /actors/<id> and /movies/<id> with async
+handlers: the token check and the queries wait on the event loop instead
+of holding a worker, the database is read through asyncdb (aiosqlite or
+asyncpg) and a token whose signing key is not cached yet is verified in
+the default thread pool, so a slow JWKS fetch only holds one thread.
+
+Those handlers answer exactly like the Flask routes of app.py: same
+parameters (pagination, filters, fields), ETags, response cache, error
+handlers and requires_auth checks, as the request parsing and the error
+responses run in a Flask request context of the same app. The context is
+only pushed around the synchronous steps, never across an await, since
+Flask keeps it per thread and every request of the loop shares the
+thread.
+
+Every other request (writes, search, ?include=, streams) goes to the
+Flask app itself in the thread pool of uvicorn's WSGI middleware, and so
+does everything when the database has no async driver installed.
+'''
+
+flask_app = create_app()
+wsgi = WSGIMiddleware(flask_app)
+
+ReadPlan = namedtuple('ReadPlan', [
+    'model', 'key', 'fields', 'statement', 'limit', 'include_total',
+    'variant', 'cache_variant', 'if_none_match'])
+Route = namedtuple('Route', ['pattern', 'permission', 'plan'])
+
+
+def build_environ(scope):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope['http_version'],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(b''),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+'''
+plan_list / plan_detail
+...the synchronous half of a handler, run in the request context once the
+token is verified and its permissions checked, like requires_auth does
+before the Flask handler: reads the parameters and builds the statement,
+or returns None to leave the request to the Flask app
+'''
+
+
+def plan_list(model, key, filters, related):
+    if included(related) or wants_stream():
+        return None
+    limit, after, include_total = get_page_args()
+    fields = get_fields(model)
+    statement = select_rows(model, fields, model.id > after,
+                            *filters()).limit(limit + 1)
+    return ReadPlan(model, key, fields, statement, limit, include_total,
+                    etag_variant(), request_variant(), request.if_none_match)
+
+
+def plan_detail(model, key, id):
+    fields = get_fields(model)
+    statement = select_rows(model, fields, model.id == id)
+    return ReadPlan(model, key, fields, statement, None, False,
+                    etag_variant(), request_variant(), request.if_none_match)
+
+
+ROUTES = [
+    Route(re.compile(r'/actors$'), 'get:actors', lambda: plan_list(
+        Actor, 'actors', actor_filters, ACTOR_INCLUDES)),
+    Route(re.compile(r'/movies$'), 'get:movies', lambda: plan_list(
+        Movie, 'movies', movie_filters, MOVIE_INCLUDES)),
+    Route(re.compile(r'/actors/(\d+)$'), 'get:actors', lambda id: plan_detail(
+        Actor, 'actor', int(id))),
+    Route(re.compile(r'/movies/(\d+)$'), 'get:movies', lambda id: plan_detail(
+        Movie, 'movie', int(id))),
+]
+
+
+def in_app_context(f, *args):
+    with flask_app.app_context():
+        try:
+            return f(*args)
+        finally:
+            db.session.remove()
+
+
+async def run_sync(f, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, f, *args)
+
+
+async def verify(token):
+    verified = token_cache.get(token)
+    if verified is None:
+        # a cold key set is fetched here, off the event loop
+        verified = token_cache.put(token,
+                                   await run_sync(verify_decode_jwt, token))
+    return verified
+
+
+async def read_table_version(database, model):
+    version = await database.scalar(select([TableVersion.version]).where(
+        TableVersion.table_name == model.__tablename__))
+    if version is None:
+        version = await run_sync(in_app_context, table_version, model)
+    return version
+
+
+async def read_row_count(database, model):
+    total = await database.scalar(select([RowCount.total]).where(
+        RowCount.table_name == model.__tablename__))
+    if total is None:
+        total = await run_sync(in_app_context, row_count, model)
+    return total
+
+
+async def execute(plan, verified):
+    database = asyncdb.reader()
+    # read the version before the rows, like conditional()
+    version = await read_table_version(database, plan.model)
+    etag = format_etag(plan.model, [version], plan.variant)
+    key = make_key(plan.model, [version], verified.payload,
+                   plan.cache_variant)
+    entry = response_cache.get(key)
+    if plan.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif entry is not None:
+        response = cached_response(entry)
+    else:
+        response = await respond(database, plan)
+        if response.status_code != 200:
+            return response
+        # the encoding is the last part of the cache variant
+        response = compress(response, plan.cache_variant[-1])
+        response_cache.set(key, cache_entry(response))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+async def respond(database, plan):
+    serialize = serializer(plan.model, plan.fields)
+    if plan.limit is None:
+        rows = await database.fetch(plan.statement)
+        if not rows:
+            abort(404)
+        return json_response({
+            "success": True,
+            plan.key: serialize(FieldRow(plan.fields, rows[0]))
+        })
+
+    try:
+        rows = await database.fetch(plan.statement)
+        result = {"success": True,
+                  plan.key: [serialize(FieldRow(plan.fields, row))
+                             for row in rows[:plan.limit]],
+                  "next_cursor": rows[plan.limit - 1][plan.fields.index('id')]
+                  if len(rows) > plan.limit else None,
+                  }
+        if plan.include_total:
+            result["total_" + plan.key] = await read_row_count(
+                database, plan.model)
+        return json_response(result)
+    except Exception:
+        abort(404)
+
+
+class FieldRow(dict):
+    """A fetched row, readable by the serializers (as attributes)."""
+    def __init__(self, fields, values):
+        super().__init__(zip(fields, values))
+
+    __getattr__ = dict.__getitem__
+
+
+async def handle(scope, route, args):
+    environ = build_environ(scope)
+    try:
+        with flask_app.request_context(environ):
+            token = get_token_auth_header()
+        verified = await verify(token)
+        check_permissions(route.permission, verified.payload,
+                          verified.permissions)
+        # the parameters are only read once the token passed, so a bad
+        # token is a 401 / 403 whatever the query string, as in Flask
+        with flask_app.request_context(environ):
+            plan = route.plan(*args)
+        if plan is None:
+            return None
+        response = await execute(plan, verified)
+    except (AuthError, HTTPException) as error:
+        with flask_app.request_context(environ):
+            return flask_app.process_response(flask_app.make_response(
+                flask_app.handle_user_exception(error)))
+    with flask_app.request_context(environ):
+        return flask_app.process_response(response)
+
+
+async def send_response(response, send):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in response.headers.items()],
+    })
+    await send({'type': 'http.response.body',
+                'body': response.get_data()})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await asyncdb.close_all()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'GET' and \
+            asyncdb.primary is not None:
+        for route in ROUTES:
+            match = route.pattern.match(scope['path'])
+            if match:
+                response = await handle(scope, route, match.groups())
+                if response is not None:
+                    return await send_response(response, send)
+                break
+    return await wsgi(scope, receive, send)
@@ -0,0 +1,146 @@
+import asyncio
+import itertools
+import re
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine.url import make_url
+from models import database_path, replica_paths, DB_POOL_SIZE
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+'''
+Async database access for the ASGI entry point (asgi.py)
+
+AsyncDatabase runs the Core statements of models.py (select_rows and
+friends) on an asyncio driver: asyncpg for Postgres, aiosqlite for SQLite
+files. Statements are compiled by SQLAlchemy for the dialect, with the
+bind and result processors of the column types, so the values are the
+same as through the sync engine.
+
+Each worker keeps at most DB_POOL_SIZE connections per database, opened
+on first use in the worker's event loop.
+'''
+
+
+class AsyncDatabase:
+    def __init__(self, url, size=DB_POOL_SIZE):
+        self.url = make_url(url)
+        self.size = size
+        self._pool = None
+        self._connections = None
+        self._opened = 0
+        if self.url.drivername.startswith('sqlite'):
+            self.dialect = sqlite.dialect(paramstyle='qmark')
+        else:
+            self.dialect = postgresql.dialect(paramstyle='format')
+
+    def compile(self, statement):
+        compiled = statement.compile(dialect=self.dialect)
+        params = []
+        for name in compiled.positiontup:
+            value = compiled.params[name]
+            process = compiled.binds[name].type.dialect_impl(
+                self.dialect).bind_processor(self.dialect)
+            params.append(process(value) if process else value)
+        sql = compiled.string
+        if self.dialect.name == 'postgresql':
+            # asyncpg takes $1, $2, ... placeholders
+            numbers = itertools.count(1)
+            sql = re.sub(r'%%|%s', lambda match: '%' if match.group() == '%%'
+                         else '$%d' % next(numbers), sql)
+        processors = [column.type.dialect_impl(
+            self.dialect).result_processor(self.dialect, None)
+            for column in statement.inner_columns]
+        return sql, params, processors
+
+    async def fetch(self, statement):
+        """Returns the rows of a Core SELECT as tuples."""
+        sql, params, processors = self.compile(statement)
+        if self.dialect.name == 'postgresql':
+            pool = await self._postgres_pool()
+            async with pool.acquire() as connection:
+                rows = await connection.fetch(sql, *params)
+        else:
+            connection = await self._sqlite_connection()
+            try:
+                async with connection.execute(sql, params) as cursor:
+                    rows = await cursor.fetchall()
+            finally:
+                self._connections.put_nowait(connection)
+        if not any(processors):
+            return [tuple(row) for row in rows]
+        return [tuple(process(value) if process else value
+                      for process, value in zip(processors, row))
+                for row in rows]
+
+    async def scalar(self, statement):
+        rows = await self.fetch(statement.limit(1))
+        return rows[0][0] if rows else None
+
+    async def _postgres_pool(self):
+        if self._pool is None:
+            url = make_url(str(self.url))
+            url.drivername = 'postgresql'
+            self._pool = await asyncpg.create_pool(
+                str(url), min_size=1, max_size=self.size)
+        return self._pool
+
+    async def _sqlite_connection(self):
+        if self._connections is None:
+            self._connections = asyncio.Queue()
+        if self._connections.empty() and self._opened < self.size:
+            self._opened += 1
+            connection = await aiosqlite.connect(self.url.database)
+            self._connections.put_nowait(connection)
+        return await self._connections.get()
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        while self._connections is not None and \
+                not self._connections.empty():
+            await self._connections.get_nowait().close()
+        self._opened = 0
+
+
+def supported(url):
+    """Whether url can be served by AsyncDatabase with the installed
+    drivers; in-memory SQLite databases are private to a connection, so
+    they never are."""
+    if not url:
+        return False
+    url = make_url(url)
+    if url.drivername.startswith('sqlite'):
+        return aiosqlite is not None and url.database not in (
+            None, '', ':memory:')
+    return url.drivername.startswith('postgres') and asyncpg is not None
+
+
+'''
+primary / reader()
+...the primary database and the round robin of the databases that serve
+reads: the DATABASE_REPLICA_URLS replicas when there are any, like
+models.use_replica
+'''
+
+primary = AsyncDatabase(database_path) if supported(database_path) else None
+_readers = [AsyncDatabase(url) for url in replica_paths if supported(url)]
+_reader_cycle = itertools.cycle(_readers or [primary])
+
+
+def reader():
+    return next(_reader_cycle)
+
+
+async def close_all():
+    for database in set([primary] + _readers):
+        if database is not None:
+            await database.close()
@@ -1,7 +1,13 @@
+import hashlib
 import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from flask import request
 from functools import wraps
 from jose import jwt
+from metrics import add_auth_time
 from urllib.request import urlopen
 
 # Default
@@ -14,6 +20,20 @@ AUTH0_DOMAIN = 'kenino.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone'
 
+# signing keys of the tenant, can point to a local key server for tests
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+# JWKS key store tuning (seconds)
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 3600))
+JWKS_REFRESH_MARGIN = int(os.environ.get('JWKS_REFRESH_MARGIN', 300))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# number of verified tokens kept per process
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
 
 # AuthError Exception
 '''
@@ -77,17 +97,21 @@ def get_token_auth_header():
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in
     the payload permissions array
+    permissions can be passed precomputed (i.e. a cached frozenset) to skip
+    reading them from the payload
     return true otherwise
 '''
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({'code': 'invalid_classsssims',
-                         'description':
-                         'permission not included in JWT.'}, 400)
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError({'code': 'invalid_classsssims',
+                             'description':
+                             'permission not included in JWT.'}, 400)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'Unauthorized',
             'description': 'Permission not found.'
@@ -96,12 +120,233 @@ def check_permissions(permission, payload):
     return True
 
 
+# JWKS Key Store
+'''
+JWKSKeyStore
+A process-wide cache of the Auth0 signing keys, indexed by kid.
+
+    keys are kept for `ttl` seconds and refreshed in a background thread
+    once they are within `refresh_margin` seconds of expiring, so requests
+    only touch the network on a cold start or after a failed refresh
+    a token carrying an unknown kid forces a refresh, at most once every
+    `min_refresh_interval` seconds, to pick up rotated keys
+    stats() exposes hit / miss / refresh counters
+    on_rotate(listener) is called back when a refresh changes the keys
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_CACHE_TTL,
+                 refresh_margin=JWKS_REFRESH_MARGIN,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 fetch=None, clock=time.monotonic):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl)
+        self.min_refresh_interval = min_refresh_interval
+        self._fetch = fetch or self._fetch_url
+        self._clock = clock
+        self._keys = {}
+        self._expires_at = 0
+        self._last_refresh = None
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._refresh_thread = None
+        self._rotation_listeners = []
+        self._stats = {'hits': 0, 'misses': 0,
+                       'refreshes': 0, 'refresh_failures': 0}
+
+    def _fetch_url(self):
+        jsonurl = urlopen(self.url, timeout=JWKS_FETCH_TIMEOUT)
+        return json.loads(jsonurl.read())
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def get_key(self, kid):
+        now = self._clock()
+        if now >= self._expires_at:
+            self.refresh(max_age=0)
+        elif now >= self._expires_at - self.refresh_margin:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            self._count('hits')
+            return key
+
+        self._count('misses')
+        last = self._last_refresh
+        if last is None or now - last >= self.min_refresh_interval:
+            self.refresh(max_age=self.min_refresh_interval)
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self, max_age=0):
+        """Reloads the key set unless another thread refreshed it
+        less than max_age seconds ago.
+        """
+        with self._refresh_lock:
+            now = self._clock()
+            if max_age and self._last_refresh is not None and \
+                    now - self._last_refresh < max_age:
+                return
+            if not max_age and now < self._expires_at:
+                return
+            self._last_refresh = now
+            try:
+                jwks = self._fetch()
+                keys = {}
+                for key in jwks['keys']:
+                    if key.get('kty') != 'RSA' or 'kid' not in key:
+                        continue
+                    keys[key['kid']] = {
+                        'kty': key['kty'],
+                        'kid': key['kid'],
+                        'use': key.get('use'),
+                        'n': key['n'],
+                        'e': key['e']
+                    }
+            except Exception:
+                self._count('refresh_failures')
+                if not self._keys:
+                    raise AuthError({
+                        'code': 'jwks_unavailable',
+                        'description': 'Unable to fetch signing keys.'
+                    }, 503)
+                # keep serving the old keys, retry after a short back-off
+                self._expires_at = max(self._expires_at,
+                                       now + self.min_refresh_interval)
+                return
+
+            rotated = bool(self._keys) and keys != self._keys
+            self._keys = keys
+            self._expires_at = now + self.ttl
+            self._count('refreshes')
+        if rotated:
+            for listener in self._rotation_listeners:
+                listener()
+
+    def on_rotate(self, listener):
+        """Registers a callable run whenever a refresh changes the key set.
+        """
+        self._rotation_listeners.append(listener)
+
+    def _refresh_in_background(self):
+        if self._refresh_thread is not None and \
+                self._refresh_thread.is_alive():
+            return
+
+        def run():
+            try:
+                self.refresh(max_age=self.min_refresh_interval)
+            except AuthError:
+                pass
+
+        self._refresh_thread = threading.Thread(
+            target=run, name='jwks-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['keys'] = len(self._keys)
+        return stats
+
+    def after_fork(self):
+        """Keeps the keys loaded before a fork (gunicorn --preload), with
+        fresh locks and no refresh thread: those of the parent may have
+        been held or running when it forked.
+        """
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._refresh_thread = None
+
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+os.register_at_fork(after_in_child=jwks_store.after_fork)
+
+
+# Verified Token Cache
+'''
+VerifiedTokenCache
+A bounded LRU of already verified tokens, keyed by the sha256 of the token.
+
+    each entry keeps the decoded payload and its permissions as a frozenset
+    and is dropped once the token's exp claim has passed
+    tokens without an exp claim are never cached
+    the whole cache is cleared when the JWKS key set rotates
+'''
+
+VerifiedToken = namedtuple('VerifiedToken',
+                           ['payload', 'permissions', 'expires_at'])
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > self._clock():
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry
+            if entry is not None:
+                del self._entries[key]
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, token, payload):
+        permissions = payload.get('permissions')
+        entry = VerifiedToken(
+            payload,
+            frozenset(permissions) if permissions is not None else None,
+            payload.get('exp'))
+        expires_at = entry.expires_at
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return entry
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
+
+
+token_cache = VerifiedTokenCache()
+jwks_store.on_rotate(token_cache.clear)
+
+
 '''
     @INPUTS
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using the cached Auth0 /.well-known/jwks.json
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -109,25 +354,14 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -164,7 +398,8 @@ def verify_decode_jwt(token):
         permission: string permission (i.e. 'post:actors')
 
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
+    it should use the verify_token method to decode the jwt, which only
+    calls verify_decode_jwt for tokens that are not cached yet
     it should use the check_permissions method validate
      claims and check the requested permission
     return the decorator which passes the decoded
@@ -172,14 +407,29 @@ def verify_decode_jwt(token):
 '''
 
 
+def verify_token(token):
+    """Returns the VerifiedToken for token, verifying the signature only
+    when it is not cached yet.
+    """
+    verified = token_cache.get(token)
+    if verified is None:
+        verified = token_cache.put(token, verify_decode_jwt(token))
+    return verified
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                verified = verify_token(token)
+                check_permissions(permission, verified.payload,
+                                  verified.permissions)
+            finally:
+                add_auth_time(time.perf_counter() - start)
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,163 @@
+'''
+Sync (gunicorn wsgi:app) vs async (uvicorn asgi:app) benchmark
+
+Seeds a temporary SQLite database, starts a local key server
+(bench/tokens.py) and each server in turn with the same number of worker
+processes, then keeps CONCURRENCY keep-alive connections busy with
+GET /actors for DURATION seconds and reports requests per second and the
+latency percentiles.
+
+    python bench/asgi_vs_wsgi.py [--workers 2] [--concurrency 256]
+        [--duration 10] [--rows 1000] [--jwks-delay 0]
+        [--path /actors?limit=50]
+
+--jwks-delay slows the key server down; with a cold key set every worker
+waits for it on its first requests.
+'''
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.tokens import JWKSServer, mint_token  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def seed(database_url, rows):
+    # in a child process, so this one never imports the app
+    subprocess.check_call([sys.executable, '-c', (
+        'from app import create_app, create_schema\n'
+        'from models import insert_many, Actor, Movie\n'
+        'app = create_app({"SQLALCHEMY_DATABASE_URI": %r})\n'
+        'create_schema(app)\n'
+        'with app.app_context():\n'
+        '    insert_many(Actor, [{"name": "actor%%d" %% i,'
+        ' "age": 20 + i %% 60, "gender": "female"} for i in range(%d)])\n'
+        '    insert_many(Movie, [{"title": "movie%%d" %% i}'
+        ' for i in range(%d)])\n') % (database_url, rows, rows)], cwd=ROOT)
+
+
+def start_server(name, port, workers, env):
+    bind = '127.0.0.1:%d' % port
+    if name == 'wsgi':
+        command = [sys.executable, '-c',
+                   'from gunicorn.app.wsgiapp import run; run()',
+                   '-w', str(workers), '-b', bind, '--log-level', 'warning',
+                   'wsgi:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', '--workers',
+                   str(workers), '--host', '127.0.0.1', '--port', str(port),
+                   '--log-level', 'warning', '--no-access-log', 'asgi:app']
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('%s did not start' % name)
+
+
+async def client(port, request, stop_at, latencies, errors):
+    # keeps one connection open, reconnecting when the server closes it
+    # (gunicorn's sync workers close it after every response)
+    while time.perf_counter() < stop_at:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            keep_alive = True
+            while keep_alive and time.perf_counter() < stop_at:
+                start = time.perf_counter()
+                writer.write(request)
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while True:
+                    line = (await reader.readline()).lower()
+                    if line in (b'\r\n', b''):
+                        break
+                    if line.startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                    elif line.startswith(b'connection:') and b'close' in line:
+                        keep_alive = False
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors.append(status)
+        except (ConnectionError, asyncio.IncompleteReadError, IndexError):
+            errors.append('connection')
+        finally:
+            writer.close()
+
+
+async def load(port, path, token, concurrency, duration):
+    request = ('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+               'Authorization: Bearer %s\r\n\r\n' % (path, token)).encode()
+    latencies, errors = [], []
+    stop_at = time.perf_counter() + duration
+    await asyncio.gather(*[client(port, request, stop_at, latencies, errors)
+                           for _ in range(concurrency)])
+    return latencies, errors
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(name, args, env, token):
+    port = free_port()
+    process = start_server(name, port, args.workers, env)
+    try:
+        # one warm-up second, then the measured run
+        asyncio.run(load(port, args.path, token, args.concurrency, 1))
+        latencies, errors = asyncio.run(load(
+            port, args.path, token, args.concurrency, args.duration))
+    finally:
+        process.terminate()
+        process.wait()
+    print('%-5s %8.0f req/s  p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms'
+          '  errors %d' % (
+              name, len(latencies) / args.duration,
+              percentile(latencies, 50) * 1000,
+              percentile(latencies, 95) * 1000,
+              percentile(latencies, 99) * 1000, len(errors)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--jwks-delay', type=float, default=0)
+    parser.add_argument('--path', default='/actors?limit=50')
+    args = parser.parse_args()
+
+    keys = JWKSServer(delay=args.jwks_delay).start()
+    token = mint_token(['get:actors', 'get:movies'])
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        seed(database_url, args.rows)
+        env = dict(os.environ, DATABASE_URL=database_url, JWKS_URL=keys.url)
+        print('%d workers, %d connections, %s, %gs' % (
+            args.workers, args.concurrency, args.path, args.duration))
+        for name in ('wsgi', 'asgi'):
+            run(name, args, env, token)
+    keys.stop()
+
+
+if __name__ == '__main__':
+    main()
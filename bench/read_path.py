@@ -0,0 +1,82 @@
+'''
+Read path microbenchmark
+
+Compares reading and formatting every actor through the ORM
+(Actor.query.all() + format()) with the Core read path used by the list
+endpoints (select_rows() + format_row()), on a temporary SQLite database.
+
+    python bench/read_path.py [rows ...]      (default: 10000 100000)
+
+Reports the best of REPEAT runs and the peak memory allocated (tracemalloc)
+of one run for each path.
+'''
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from models import (setup_db, db, format_row, insert_many,  # noqa: E402
+                    model_fields, read_rows, select_rows, Actor)
+
+REPEAT = 3
+
+
+def orm_read():
+    rows = [actor.format() for actor in Actor.query.order_by(Actor.id)]
+    db.session.remove()
+    return rows
+
+
+def core_read():
+    fields = model_fields(Actor)
+    rows = [format_row(row, fields) for row in read_rows(
+        select_rows(Actor, fields)).fetchall()]
+    db.session.remove()
+    return rows
+
+
+def measure(read):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        read()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    read()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run(count):
+    with tempfile.TemporaryDirectory() as directory:
+        app = Flask(__name__)
+        setup_db(app, 'sqlite:///' + os.path.join(directory, 'bench.db'), [])
+        with app.app_context():
+            db.create_all(bind=None)
+            insert_many(Actor, [{'name': 'actor%d' % i, 'age': 20 + i % 60,
+                                 'gender': 'female'} for i in range(count)])
+            assert orm_read() == core_read()
+            results = [(name, measure(read)) for name, read in
+                       (('orm', orm_read), ('core', core_read))]
+            db.session.remove()
+            db.get_engine().dispose()
+
+    print('%d rows' % count)
+    for name, (elapsed, peak) in results:
+        print('  %-5s %8.1f ms %10.1f MiB peak' % (
+            name, elapsed * 1000, peak / 2 ** 20))
+    orm, core = results[0][1], results[1][1]
+    print('  core/orm: %.2fx time, %.2fx memory' % (
+        core[0] / orm[0], core[1] / orm[1]))
+
+
+if __name__ == '__main__':
+    for count in [int(arg) for arg in sys.argv[1:]] or [10000, 100000]:
+        run(count)
@@ -0,0 +1,329 @@
+'''
+Offline benchmark suite
+
+Drives every route of app.py in process, with no network service: tokens
+are signed by a local key pair and their keys served by a local JWKS
+stand-in (bench/tokens.py), and the database is a temporary SQLite file
+seeded for the run, or the database at --database-url (Postgres too).
+
+For each scenario, REQUESTS requests are sent by CONCURRENCY threads
+through the Flask test client; the report has the throughput, the
+p50 / p95 / p99 latencies and the SQL statements per request.
+
+    python bench/suite.py [--actors 1000] [--movies 1000] [--cast 5]
+        [--requests 500] [--concurrency 8] [--only actors]
+        [--no-response-cache] [--database-url URL]
+        [--baseline COMMIT]
+
+Results are written to bench/results/<commit>.json (with -dirty when the
+tree has changes); --baseline COMMIT prints the change against a
+previous result next to each scenario.
+'''
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+sys.path.insert(0, ROOT)
+
+from bench.tokens import JWKSServer, mint_token  # noqa: E402
+
+PERMISSIONS = ['get:actors', 'get:movies', 'post:actors', 'post:movies',
+               'patch:actors', 'patch:movies', 'delete:actors',
+               'delete:movies']
+
+'''
+Scenario
+...one benchmarked request: request(i) returns the (path, json body) of
+the i-th request, prepare(count) creates what count requests consume
+(e.g. the rows deleted) and returns it as the argument of request
+'''
+
+Scenario = namedtuple('Scenario', ['name', 'method', 'rule', 'request',
+                                   'prepare'])
+
+
+def scenarios(args):
+    actors, movies = args.actors, args.movies
+
+    def actor(i):
+        return i % actors + 1
+
+    def movie(i):
+        return i % movies + 1
+
+    def person(i):
+        return {'name': 'bench%d' % i, 'age': 20 + i % 60,
+                'gender': 'female'}
+
+    return [
+        Scenario('index', 'GET', '/', lambda i, _: ('/', None), None),
+        Scenario('list actors', 'GET', '/actors',
+                 lambda i, _: ('/actors?limit=50&after=%d' % (
+                     i * 50 % actors), None), None),
+        Scenario('list actors filtered', 'GET', '/actors',
+                 lambda i, _: ('/actors?gender=female&age_min=%d'
+                               '&fields=name' % (20 + i % 40), None), None),
+        Scenario('list movies with cast', 'GET', '/movies',
+                 lambda i, _: ('/movies?limit=50&include=actors&after=%d' % (
+                     i * 50 % movies), None), None),
+        Scenario('stream movies', 'GET', '/movies',
+                 lambda i, _: ('/movies?stream=1', None), None),
+        Scenario('get actor', 'GET', '/actors/<int:actor_id>',
+                 lambda i, _: ('/actors/%d' % actor(i), None), None),
+        Scenario('get movie', 'GET', '/movies/<int:movie_id>',
+                 lambda i, _: ('/movies/%d' % movie(i), None), None),
+        Scenario('cast of movie', 'GET', '/movies/<int:movie_id>/actors',
+                 lambda i, _: ('/movies/%d/actors' % movie(i), None), None),
+        Scenario('movies of actor', 'GET', '/actors/<int:actor_id>/movies',
+                 lambda i, _: ('/actors/%d/movies' % actor(i), None), None),
+        Scenario('search', 'GET', '/search',
+                 lambda i, _: ('/search?q=actor%d' % (i % 100), None), None),
+        Scenario('metrics', 'GET', '/metrics',
+                 lambda i, _: ('/metrics', None), None),
+        Scenario('create actor', 'POST', '/actors',
+                 lambda i, _: ('/actors', person(i)), None),
+        Scenario('create movie', 'POST', '/movies',
+                 lambda i, _: ('/movies', {'title': 'bench%d' % i}), None),
+        Scenario('bulk create actors', 'POST', '/actors/bulk',
+                 lambda i, _: ('/actors/bulk', [person(i * 100 + j)
+                                                for j in range(100)]), None),
+        Scenario('bulk create movies', 'POST', '/movies/bulk',
+                 lambda i, _: ('/movies/bulk', [{'title': 'bench%d' % j}
+                                                for j in range(100)]), None),
+        Scenario('update actor', 'PATCH', '/actors/<int:id>',
+                 lambda i, _: ('/actors/%d' % actor(i), {'age': 30 + i % 40}),
+                 None),
+        Scenario('update movie', 'PATCH', '/movies/<int:movie_id>',
+                 lambda i, _: ('/movies/%d' % movie(i),
+                               {'title': 'renamed%d' % i}), None),
+        Scenario('cast actor', 'POST', '/movies/<int:movie_id>/actors',
+                 lambda i, ids: ('/movies/%d/actors' % movie(i),
+                                 {'actor_id': ids[i]}),
+                 lambda count: create_rows('actors', count)),
+        Scenario('uncast actor', 'DELETE',
+                 '/movies/<int:movie_id>/actors/<int:actor_id>',
+                 lambda i, pairs: ('/movies/%d/actors/%d' % pairs[i], None),
+                 lambda count: create_links(count, movies)),
+        Scenario('delete actor', 'DELETE', '/actors/<int:actor_id>',
+                 lambda i, ids: ('/actors/%d' % ids[i], None),
+                 lambda count: create_rows('actors', count)),
+        Scenario('delete movie', 'DELETE', '/movies/<int:movie_id>',
+                 lambda i, ids: ('/movies/%d' % ids[i], None),
+                 lambda count: create_rows('movies', count)),
+    ]
+
+
+def create_rows(table, count):
+    from models import insert_many, Actor, Movie
+    if table == 'actors':
+        return insert_many(Actor, [{'name': 'spare%d' % i, 'age': 30,
+                                    'gender': 'male'} for i in range(count)])
+    return insert_many(Movie, [{'title': 'spare%d' % i}
+                               for i in range(count)])
+
+
+def create_links(count, movies):
+    from models import db, actors_movies
+    pairs = [(i % movies + 1, actor_id)
+             for i, actor_id in enumerate(create_rows('actors', count))]
+    db.session.execute(actors_movies.insert(), [
+        {'movie_id': movie_id, 'actor_id': actor_id}
+        for movie_id, actor_id in pairs])
+    db.session.commit()
+    return pairs
+
+
+def seed(args):
+    from models import db, actors_movies, insert_many, Actor, Movie
+    actor_ids = insert_many(Actor, [
+        {'name': 'actor%d' % i, 'age': 20 + i % 60,
+         'gender': ('female', 'male')[i % 2]} for i in range(args.actors)])
+    movie_ids = insert_many(Movie, [{'title': 'movie%d' % i}
+                                    for i in range(args.movies)])
+    links = [{'movie_id': movie_id,
+              'actor_id': actor_ids[(i * args.cast + j) % len(actor_ids)]}
+             for i, movie_id in enumerate(movie_ids)
+             for j in range(min(args.cast, len(actor_ids)))]
+    if links:
+        db.session.execute(actors_movies.insert(), links)
+        db.session.commit()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(app, scenario, args, headers, statements):
+    from models import db
+    with app.app_context():
+        prepared = scenario.prepare(args.requests) if scenario.prepare \
+            else None
+        db.session.remove()
+    numbers = itertools.count()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def work():
+        client = app.test_client()
+        while True:
+            with lock:
+                i = next(numbers)
+            if i >= args.requests:
+                return
+            path, body = scenario.request(i, prepared)
+            start = time.perf_counter()
+            res = client.open(path, method=scenario.method, json=body,
+                              headers=headers)
+            res.get_data()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if res.status_code >= 400:
+                    errors.append(res.status_code)
+
+    before = statements[0]
+    start = time.perf_counter()
+    threads = [threading.Thread(target=work)
+               for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'queries_per_request': (statements[0] - before) / len(latencies),
+    }
+
+
+def commit_id():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def load_baseline(name):
+    path = name if os.path.exists(name) else os.path.join(
+        RESULTS_DIR, name + '.json')
+    with open(path) as f:
+        return {result['name']: result for result in json.load(f)['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--cast', type=int, default=5,
+                        help='actors per movie')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--only', help='run the scenarios containing this')
+    parser.add_argument('--no-response-cache', action='store_true')
+    parser.add_argument('--database-url',
+                        help='an empty database, default a SQLite file')
+    parser.add_argument('--baseline', help='commit or results file')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        directory, 'bench.db')
+    # before app.py is imported, it reads them at import
+    os.environ['DATABASE_URL'] = database_url
+    keys = JWKSServer().start()
+    os.environ['JWKS_URL'] = keys.url
+
+    import auth
+    from app import create_app, create_schema
+    from cache import response_cache
+    from models import db
+    from sqlalchemy import event
+
+    auth.jwks_store.url = keys.url
+    if args.no_response_cache:
+        response_cache.backend.maxsize = 0
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url})
+    create_schema(app)
+    with app.app_context():
+        seed(args)
+        engine = db.engine
+        db.session.remove()
+
+    statements = [0]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    headers = {'Authorization': 'Bearer ' + mint_token(PERMISSIONS)}
+    selected = [scenario for scenario in scenarios(args)
+                if not args.only or args.only in scenario.name]
+    covered = {(scenario.rule, scenario.method)
+               for scenario in scenarios(args)}
+    for rule in app.url_map.iter_rules():
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            if rule.endpoint != 'static' and \
+                    (rule.rule, method) not in covered:
+                print('no scenario for %s %s' % (method, rule.rule))
+
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    results = []
+    print('%-24s %8s %8s %8s %8s %8s %6s' % (
+        'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries',
+        'errors'))
+    for scenario in selected:
+        result = dict(name=scenario.name, method=scenario.method,
+                      rule=scenario.rule,
+                      **run(app, scenario, args, headers, statements))
+        results.append(result)
+        line = '%-24s %8.0f %8.2f %8.2f %8.2f %8.1f %6d' % (
+            scenario.name, result['rps'], result['p50_ms'],
+            result['p95_ms'], result['p99_ms'],
+            result['queries_per_request'], result['errors'])
+        previous = baseline.get(scenario.name)
+        if previous:
+            line += '   req/s %+.0f%%  p95 %+.0f%%' % (
+                (result['rps'] / previous['rps'] - 1) * 100,
+                (result['p95_ms'] / previous['p95_ms'] - 1) * 100)
+        print(line)
+
+    keys.stop()
+    shutil.rmtree(directory)
+    commit = commit_id()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, commit + '.json')
+    with open(path, 'w') as f:
+        json.dump({'commit': commit,
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'settings': {name: value for name, value in
+                                vars(args).items()
+                                if name not in ('baseline', 'database_url')},
+                   'database': engine.dialect.name,
+                   'results': results}, f, indent=2, sort_keys=True)
+    print('results written to %s' % os.path.relpath(path, ROOT))
+
+
+if __name__ == '__main__':
+    main()
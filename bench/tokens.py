@@ -0,0 +1,93 @@
+'''
+Local signing keys for the benchmarks
+
+mint_token(permissions) signs an RS256 token the API accepts (issuer
+https://<AUTH0_DOMAIN>/, audience API_AUDIENCE) with a key generated for
+the run, and JWKSServer serves the matching key set over HTTP, so the
+benchmarks exercise the real token check without Auth0:
+
+    server = JWKSServer().start()
+    # JWKS_URL=server.url in the environment of the API process, or
+    # auth.jwks_store.url = server.url when it runs in this one
+    token = mint_token(['get:actors'])
+
+delay (seconds) slows every key set request down, to measure a cold or
+slow key fetch.
+'''
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from auth import ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN  # noqa: E402
+
+KID = 'bench'
+
+_private_key = rsa.generate_private_key(
+    public_exponent=65537, key_size=2048, backend=default_backend())
+PRIVATE_PEM = _private_key.private_bytes(
+    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+    serialization.NoEncryption()).decode('ascii')
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+_public_numbers = _private_key.public_key().public_numbers()
+JWKS = {'keys': [{'kty': 'RSA', 'use': 'sig', 'alg': ALGORITHMS[0],
+                  'kid': KID, 'n': _b64(_public_numbers.n),
+                  'e': _b64(_public_numbers.e)}]}
+
+
+def mint_token(permissions, ttl=3600, subject='bench'):
+    now = int(time.time())
+    claims = {'iss': 'https://' + AUTH0_DOMAIN + '/', 'aud': API_AUDIENCE,
+              'sub': subject, 'iat': now, 'exp': now + ttl,
+              'permissions': sorted(permissions)}
+    return jwt.encode(claims, PRIVATE_PEM, algorithm=ALGORITHMS[0],
+                      headers={'kid': KID})
+
+
+class JWKSServer:
+    def __init__(self, delay=0.0, host='127.0.0.1', port=0):
+        body = json.dumps(JWKS).encode('utf-8')
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.url = 'http://%s:%d/.well-known/jwks.json' % (
+            host, self.httpd.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
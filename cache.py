@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from flask import make_response, request, Response
+from compression import compress, negotiate
+from conditional import request_models, request_table_version
+from models import on_table_change
+from streaming import wants_ndjson
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+
+'''
+Response cache
+
+cached(model) keeps the serialized body of a list response, keyed by the
+table, its current version (and those of the included tables), the route,
+the query parameters, the permission scope of the token and the
+negotiated content type. Since the table version is part of the key, a
+write anywhere (any worker) makes the old entries unreachable; the writes
+of this process also drop them right away through models.on_table_change.
+
+The storage is a pluggable backend with get / set / invalidate / stats,
+MemoryBackend (a per process LRU with a TTL) by default.
+'''
+
+CachedResponse = namedtuple('CachedResponse', [
+    'body', 'status', 'content_type', 'content_encoding'])
+
+
+def cache_entry(response):
+    return CachedResponse(response.get_data(), response.status_code,
+                          response.content_type,
+                          response.headers.get('Content-Encoding'))
+
+
+def cached_response(entry):
+    response = Response(entry.body, entry.status,
+                        content_type=entry.content_type)
+    if entry.content_encoding:
+        response.headers['Content-Encoding'] = entry.content_encoding
+    return response
+
+
+class MemoryBackend:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[0] > self._clock():
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return item[1]
+            if item is not None:
+                del self._entries[key]
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, table_name):
+        with self._lock:
+            for key in [key for key in self._entries
+                        if key[0] == table_name]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def invalidate(self, table_name):
+        self.backend.invalidate(table_name)
+
+    def stats(self):
+        return self.backend.stats()
+
+
+response_cache = ResponseCache(MemoryBackend())
+on_table_change(response_cache.invalidate)
+
+
+def request_variant():
+    """The parts of the cache key that come from the request itself."""
+    return (request.path,
+            tuple(sorted(request.args.items(multi=True))),
+            wants_ndjson(), negotiate())
+
+
+def make_key(model, versions, token, variant):
+    permissions = token.get('permissions') or ()
+    return (model.__tablename__, tuple(versions),
+            tuple(sorted(permissions))) + variant
+
+
+def cache_key(model, token, related=None, parent=None):
+    versions = [request_table_version(m)
+                for m in request_models(model, related or {}, parent)]
+    return make_key(model, versions, token, request_variant())
+
+
+'''
+cached(model)
+...serves a GET handler from response_cache; goes between requires_auth
+(it needs the token for the permission scope) and the handler.
+Only complete 200 responses are stored, never streamed ones, compressed
+for the negotiated encoding (which is part of the key).
+related and parent are the same as for conditional(model, related, parent).
+'''
+
+
+def cached(model, related=None, parent=None):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(token, *args, **kwargs):
+            key = cache_key(model, token, related, parent)
+            entry = response_cache.get(key)
+            if entry is not None:
+                return cached_response(entry)
+
+            response = make_response(f(token, *args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response = compress(response, key[-1])
+                response_cache.set(key, cache_entry(response))
+            return response
+
+        return wrapper
+    return cached_decorator
@@ -0,0 +1,92 @@
+import os
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+# in order of preference; br only with the brotli package installed
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+'''
+Response compression
+
+init_app(app) compresses the JSON and NDJSON responses of the app with
+the encoding the client prefers among br and gzip (Accept-Encoding):
+
+    complete responses of COMPRESSION_MIN_SIZE bytes (default 1024) or more
+    streamed responses always, chunk by chunk: every chunk is flushed, so
+    the client still gets the rows as they are read
+
+and marks them all Vary: Accept-Encoding. The cache and the ETags of
+conditional GETs are per encoding (cache.py, conditional.py); the cache
+stores the compressed body, so a hit is sent as is.
+'''
+
+
+def negotiate():
+    """The encoding for the current request, or None for identity."""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def _compressor(encoding):
+    """Returns (compress(chunk), finish()) for a stream of chunks."""
+    if encoding == 'br':
+        stream = brotli.Compressor(quality=BROTLI_QUALITY)
+        return (lambda chunk: stream.process(chunk) + stream.flush(),
+                stream.finish)
+    # wbits 31: a gzip header and trailer around the deflate stream
+    stream = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return (lambda chunk: stream.compress(chunk) +
+            stream.flush(zlib.Z_SYNC_FLUSH),
+            stream.flush)
+
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    stream = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return stream.compress(data) + stream.flush()
+
+
+def compress_chunks(chunks, encoding):
+    compress, finish = _compressor(encoding)
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress(response, encoding):
+    """Compresses response with encoding (None: leaves it as is) when it
+    is worth it; returns it."""
+    if response.status_code != 200 or \
+            response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if encoding is None or 'Content-Encoding' in response.headers:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress_body(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    @app.after_request
+    def compress_response(response):
+        return compress(response, negotiate())
@@ -0,0 +1,91 @@
+import hashlib
+from functools import wraps
+from flask import abort, g, make_response, request
+from compression import negotiate
+from models import table_version
+
+'''
+Conditional GETs
+
+conditional(model) wraps a list handler so it answers with an ETag derived
+from the table version of model, and with 304 Not Modified, without
+reading any rows, when the client's If-None-Match still matches.
+
+The tag also covers the query string, the negotiated content type and
+content encoding, as they change the representation of the same table
+version; both the 200 and the 304 responses say Vary: Accept-Encoding.
+
+related maps the values of the include parameter to relationships of
+model; the tables of the included relationships are part of the tag too.
+
+parent is the model of the row a nested list belongs to (the movie of
+/movies/<id>/actors): its table is part of the tag, so deleting the parent
+changes the tag even when the list itself is untouched.
+'''
+
+
+def request_table_version(model):
+    """Returns the table version of model, read once per request."""
+    versions = g.setdefault('table_versions', {})
+    if model.__tablename__ not in versions:
+        versions[model.__tablename__] = table_version(model)
+    return versions[model.__tablename__]
+
+
+def included(related):
+    """Returns the names and relationships asked for by the include
+    parameter."""
+    names = [name for name in request.args.get('include', '').split(',')
+             if name]
+    if any(name not in related for name in names):
+        abort(400)
+    return [(name, related[name]) for name in sorted(set(names))]
+
+
+def request_models(model, related, parent=None):
+    return [model] + [relationship.property.mapper.class_
+                      for _, relationship in included(related)] + \
+        ([parent] if parent is not None else [])
+
+
+def etag_variant():
+    variant = hashlib.sha1(request.query_string)
+    variant.update(request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson'], '').encode('utf-8'))
+    variant.update((negotiate() or '').encode('utf-8'))
+    return variant.hexdigest()[:12]
+
+
+def format_etag(model, versions, variant):
+    return '%s-%s-%s' % (model.__tablename__,
+                         '.'.join(str(version) for version in versions),
+                         variant)
+
+
+def table_etag(model, related=None, parent=None):
+    versions = [request_table_version(m)
+                for m in request_models(model, related or {}, parent)]
+    return format_etag(model, versions, etag_variant())
+
+
+def conditional(model, related=None, parent=None):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # read the version before the rows, so the tag is never newer
+            # than the data it is sent with
+            etag = table_etag(model, related, parent)
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            # the tag is per encoding: a 304 revalidates one encoding only
+            response.vary.add('Accept-Encoding')
+            return response
+
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,39 @@
+import app
+import metrics
+import models
+
+'''
+gunicorn settings, used by the Procfile (gunicorn -c gunicorn.conf.py)
+
+the engine is disposed around every fork, so workers open their own
+connections instead of sharing the ones of a preloaded master, which warms
+the app up (app.warm_up) before forking any worker; with
+METRICS_DIR set, the metrics files of the last run are removed at start and
+the last totals of an exiting worker are written and folded into the
+archive (metrics.py)
+'''
+
+
+def on_starting(server):
+    metrics.clear()
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        app.warm_up(server.app.wsgi())
+
+
+def pre_fork(server, worker):
+    models.dispose_engine()
+
+
+def post_fork(server, worker):
+    models.dispose_engine()
+
+
+def worker_exit(server, worker):
+    metrics.flush()
+
+
+def child_exit(server, worker):
+    metrics.retire_worker(worker.pid)
@@ -0,0 +1,242 @@
+import csv
+import io
+import json
+import os
+import time
+from flask_script import Command, Option
+from sqlalchemy import func, inspect, select
+from app import missing_fields, ACTOR_FIELDS, MOVIE_FIELDS
+from models import (db, bump_row_count, bump_table_version, rows_changed,
+                    Actor, Movie)
+
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 10000))
+
+'''
+Bulk import
+
+    python manage.py import actors|movies <file> [--format csv|ndjson]
+        [--batch-size 10000] [--defer-indexes]
+
+Reads a CSV file (with a header line) or NDJSON (one object per line),
+as a stream, and loads the rows in one transaction:
+
+    on Postgres each batch is a COPY ... FROM STDIN
+    on SQLite each batch is an executemany
+
+Rows are checked like POST /actors and POST /movies: the same fields,
+none of them missing or empty, and each converted to the type of its
+column; the rows that fail are skipped and reported with their line
+number. Other columns get their defaults (release_date now) and other
+fields of the file are ignored.
+
+--defer-indexes drops the secondary indexes of the table before loading
+and creates them again after, in the same transaction: one index build
+instead of an update per row, for large imports. Dropping an index takes
+an ACCESS EXCLUSIVE lock on Postgres, held until the import commits, which
+blocks every read of the table (GET /actors too), so the flag is refused
+unless the table is empty: an initial load, before the API uses it. The
+row count, table version and search index are updated once at the end.
+'''
+
+MODELS = {'actors': (Actor, ACTOR_FIELDS), 'movies': (Movie, MOVIE_FIELDS)}
+MAX_REPORTED_ERRORS = 20
+
+
+class ImportRefused(Exception):
+    pass
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    return 'csv' if extension == '.csv' else 'ndjson'
+
+
+def read_records(file, format):
+    """Yields (line number, dict or None) for every record of file; an
+    NDJSON line that is not a JSON object is None."""
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+def column_defaults(model, fields):
+    defaults = {}
+    for column in model.__table__.columns:
+        default = column.default
+        if column.key in fields or column.primary_key or default is None \
+                or not default.is_scalar and not default.is_callable:
+            continue
+        defaults[column.key] = default
+    return defaults
+
+
+def validator(model, fields):
+    """Returns validate(record), which returns (row, None) or (None, error
+    message)."""
+    types = [(field, model.__table__.c[field].type.python_type)
+             for field in fields]
+
+    def validate(record):
+        missing = missing_fields(record, fields)
+        if missing:
+            return None, 'missing or empty fields: %s' % ', '.join(missing)
+        row = {}
+        for field, python_type in types:
+            value = record[field]
+            if type(value) is not python_type:
+                try:
+                    value = python_type(value)
+                except (TypeError, ValueError):
+                    return None, 'invalid %s: %r' % (field, value)
+            row[field] = value
+        return row, None
+    return validate
+
+
+def batches(records, model, fields, size, errors):
+    defaults = column_defaults(model, fields)
+    validate = validator(model, fields)
+    batch = []
+    for number, record in records:
+        if record is None:
+            errors.append((number, 'invalid JSON object'))
+            continue
+        row, error = validate(record)
+        if error:
+            errors.append((number, error))
+            continue
+        for key, default in defaults.items():
+            row[key] = default.arg(None) if default.is_callable \
+                else default.arg
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_batch(connection, table, batch):
+    columns = list(batch[0])
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for row in batch:
+        writer.writerow([row[column] for column in columns])
+    data.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+            table.name, ', '.join(columns)), data)
+    finally:
+        cursor.close()
+
+
+def secondary_indexes(connection, table):
+    existing = {index['name'] for index in
+                inspect(connection).get_indexes(table.name)}
+    return [index for index in table.indexes if index.name in existing]
+
+
+def announce_new_rows(connection, model, fields, last_id, batch_size):
+    # COPY returns no ids: the new rows are those past the highest id
+    # before the import, read back a batch at a time
+    table = model.__table__
+    columns = [table.c.id] + [table.c[field] for field in fields]
+    while True:
+        rows = connection.execute(
+            select(columns).where(table.c.id > last_id)
+            .order_by(table.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return
+        rows_changed(connection, model, 'insert', [dict(row) for row in rows])
+        last_id = rows[-1][0]
+
+
+def import_file(table_name, path, format=None, batch_size=IMPORT_BATCH_SIZE,
+                defer_indexes=False):
+    """Imports the file and returns (rows imported, [(line, error)],
+    seconds); raises ImportRefused for defer_indexes on a table with
+    rows."""
+    model, fields = MODELS[table_name]
+    table = model.__table__
+    format = format or detect_format(path)
+    errors = []
+    imported = 0
+    start = time.perf_counter()
+    connection = db.session.connection()
+    try:
+        last_id = connection.execute(
+            select([func.coalesce(func.max(table.c.id), 0)])).scalar()
+        if defer_indexes and connection.execute(
+                select([table.c.id]).limit(1)).first() is not None:
+            raise ImportRefused(
+                '--defer-indexes locks %s against reads until the import '
+                'commits; it is only allowed on an empty table' % table.name)
+        deferred = secondary_indexes(connection, table) \
+            if defer_indexes else []
+        for index in deferred:
+            index.drop(connection)
+
+        with open(path, newline='', encoding='utf-8') as file:
+            for batch in batches(read_records(file, format), model, fields,
+                                 batch_size, errors):
+                if connection.dialect.name == 'postgresql':
+                    copy_batch(connection, table, batch)
+                else:
+                    connection.execute(table.insert(), batch)
+                imported += len(batch)
+
+        for index in deferred:
+            index.create(connection)
+        if imported:
+            announce_new_rows(connection, model, fields, last_id, batch_size)
+            bump_row_count(connection, table.name, imported)
+            bump_table_version(connection, table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return imported, errors, time.perf_counter() - start
+
+
+class ImportCommand(Command):
+    """Imports actors or movies from a CSV or NDJSON file."""
+
+    option_list = (
+        Option('table', choices=sorted(MODELS)),
+        Option('path'),
+        Option('--format', dest='format', choices=('csv', 'ndjson'),
+               help='default: csv for .csv files, ndjson otherwise'),
+        Option('--batch-size', dest='batch_size', type=int,
+               default=IMPORT_BATCH_SIZE),
+        Option('--defer-indexes', dest='defer_indexes',
+               action='store_true',
+               help='rebuild the indexes of the table after loading; '
+               'empty tables only, as it blocks reads of the table until '
+               'the import commits'),
+    )
+
+    def run(self, table, path, format, batch_size, defer_indexes):
+        try:
+            imported, errors, seconds = import_file(
+                table, path, format, batch_size, defer_indexes)
+        except ImportRefused as error:
+            print(error)
+            return 1
+        for number, error in errors[:MAX_REPORTED_ERRORS]:
+            print('line %d: %s' % (number, error))
+        if len(errors) > MAX_REPORTED_ERRORS:
+            print('... and %d more' % (len(errors) - MAX_REPORTED_ERRORS))
+        print('imported %d %s in %.2fs (%.0f rows/s), %d rows rejected' % (
+            imported, table, seconds, imported / seconds if seconds else 0,
+            len(errors)))
@@ -1,12 +1,24 @@
-from flask_script import Manager
+from flask_script import Command, Manager
 from flask_migrate import Migrate, MigrateCommand
-from app import app
+from app import create_app, create_schema
+from importer import ImportCommand
 from models import db
 
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
+
+class CreateDbCommand(Command):
+    """Creates the missing tables and the search index."""
+
+    def run(self):
+        create_schema(app)
+
+
 manager.add_command('db', MigrateCommand)
+manager.add_command('create_db', CreateDbCommand())
+manager.add_command('import', ImportCommand())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,325 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from flask import Response, _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+# seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+'''
+Metrics
+
+init_app(app) times every request of the app and serves the totals at
+GET /metrics in the Prometheus text format:
+
+    http_requests_total{route, method, status}
+    http_request_duration_seconds{route, method}    whole request
+    http_request_auth_seconds{route, method}        in requires_auth
+    http_request_db_seconds{route, method}          in SQL statements
+    db_query_duration_seconds{route}                per SQL statement
+
+route is the URL rule, e.g. /actors/<int:actor_id>. The database time
+comes from the cursor events of every engine, the auth time from
+requires_auth (auth.py calls add_auth_time).
+
+Each process counts in memory. With several gunicorn workers, set
+METRICS_DIR to a directory shared by the workers: each one writes its
+totals there at most every METRICS_FLUSH_INTERVAL seconds and /metrics
+adds up the files of all of them (gunicorn.conf.py folds the files of
+exited workers into one, so the totals never go back).
+'''
+
+
+class Registry:
+    """Counters and histograms, keyed by (metric name, label values)."""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        # per key: the count of every bucket (not cumulative), then the sum
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (
+                    len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def record(self, status_labels, labels, observations):
+        """Counts a request and observes its durations, under one lock."""
+        buckets = self.buckets
+        with self._lock:
+            key = ('http_requests_total', status_labels)
+            self.counters[key] = self.counters.get(key, 0) + 1
+            for name, value in observations:
+                histogram = self.histograms.get((name, labels))
+                if histogram is None:
+                    histogram = self.histograms[(name, labels)] = [0] * (
+                        len(buckets) + 1) + [0.0]
+                histogram[bisect.bisect_left(buckets, value)] += 1
+                histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for
+                             (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), list(values)] for
+                               (name, labels), values in
+                               self.histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(labels))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = list(values)
+                else:
+                    for i, value in enumerate(values):
+                        histogram[i] += value
+
+
+LABELS = {
+    'http_requests_total': ('route', 'method', 'status'),
+    'http_request_duration_seconds': ('route', 'method'),
+    'http_request_auth_seconds': ('route', 'method'),
+    'http_request_db_seconds': ('route', 'method'),
+    'db_query_duration_seconds': ('route',),
+}
+
+HELP = {
+    'http_requests_total': 'Requests by route, method and status.',
+    'http_request_duration_seconds': 'Request duration.',
+    'http_request_auth_seconds': 'Time spent verifying the token.',
+    'http_request_db_seconds': 'Time spent in SQL statements.',
+    'db_query_duration_seconds': 'SQL statement duration.',
+}
+
+
+def _labels(name, values, extra=''):
+    pairs = ['%s="%s"' % (label, str(value).replace('\\', '\\\\').replace(
+        '"', '\\"')) for label, value in zip(LABELS[name], values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs)
+
+
+def render(registry):
+    lines = []
+    counters, histograms = {}, {}
+    for (name, labels), value in sorted(registry.counters.items()):
+        counters.setdefault(name, []).append((labels, value))
+    for (name, labels), values in sorted(registry.histograms.items()):
+        histograms.setdefault(name, []).append((labels, values))
+
+    for name, series in counters.items():
+        lines.append('# HELP %s %s' % (name, HELP[name]))
+        lines.append('# TYPE %s counter' % name)
+        for labels, value in series:
+            lines.append('%s%s %s' % (name, _labels(name, labels), value))
+    for name, series in histograms.items():
+        lines.append('# HELP %s %s' % (name, HELP[name]))
+        lines.append('# TYPE %s histogram' % name)
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(registry.buckets + ('+Inf',),
+                                    values[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(
+                    name, labels, 'le="%s"' % bound), cumulative))
+            lines.append('%s_sum%s %r' % (name, _labels(name, labels),
+                                          values[-1]))
+            lines.append('%s_count%s %d' % (name, _labels(name, labels),
+                                            cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+_request = threading.local()
+# pid of the process whose flush thread runs
+_flusher = [None]
+
+
+'''
+request timing
+...before_request starts the clock and the auth / db accumulators of the
+thread's request, the engine events and add_auth_time add to them and
+after_request (or teardown_request for unhandled errors) records it all
+'''
+
+
+def _start_request():
+    # the request itself, not the request proxy: a few microseconds less
+    current = _request_ctx_stack.top.request
+    rule = current.url_rule
+    _request.route = rule.rule if rule is not None else '<unmatched>'
+    _request.labels = (_request.route, current.method)
+    _request.auth = 0.0
+    _request.db = 0.0
+    _request.start = time.perf_counter()
+
+
+def _finish_request(status):
+    start = getattr(_request, 'start', None)
+    if start is None:
+        return
+    _request.start = None
+    elapsed = time.perf_counter() - start
+    labels = _request.labels
+    registry.record(labels + (status,), labels, (
+        ('http_request_duration_seconds', elapsed),
+        ('http_request_auth_seconds', _request.auth),
+        ('http_request_db_seconds', _request.db)))
+    if METRICS_DIR and _flusher[0] != os.getpid():
+        start_flusher()
+
+
+def _after_request(response):
+    _finish_request(response.status_code)
+    return response
+
+
+def _teardown_request(error):
+    _finish_request(500)
+
+
+def add_auth_time(seconds):
+    if getattr(_request, 'start', None) is not None:
+        _request.auth += seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('metrics_query_start', []).append(
+        time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if getattr(_request, 'start', None) is not None:
+        _request.db += elapsed
+        route = _request.route
+    else:
+        route = '<none>'
+    registry.observe('db_query_duration_seconds', (route,), elapsed)
+
+
+'''
+multi-process files
+...flush() writes the totals of this process to METRICS_DIR (from a
+thread started by the first request, so after gunicorn forked), collect()
+adds up every file (and this process' live totals), retire_worker(pid)
+folds the file of an exited worker into archive.json and clear() empties
+the directory when the server starts
+'''
+
+
+def _worker_file(pid):
+    return os.path.join(METRICS_DIR, 'worker-%d.json' % pid)
+
+
+def _write(path, snapshot):
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temporary, path)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def flush():
+    if METRICS_DIR:
+        _write(_worker_file(os.getpid()), registry.snapshot())
+
+
+def start_flusher():
+    def run():
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            flush()
+
+    _flusher[0] = os.getpid()
+    threading.Thread(target=run, name='metrics', daemon=True).start()
+
+
+def collect():
+    if not METRICS_DIR:
+        return registry
+    total = Registry(registry.buckets)
+    own = _worker_file(os.getpid())
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        snapshot = _read(path) if path != own else None
+        if snapshot is not None:
+            total.merge(snapshot)
+    total.merge(registry.snapshot())
+    return total
+
+
+def retire_worker(pid):
+    if not METRICS_DIR:
+        return
+    snapshot = _read(_worker_file(pid))
+    if snapshot is None:
+        return
+    archive = Registry()
+    archive_path = os.path.join(METRICS_DIR, 'archive.json')
+    for previous in (_read(archive_path), snapshot):
+        if previous is not None:
+            archive.merge(previous)
+    _write(archive_path, archive.snapshot())
+    os.remove(_worker_file(pid))
+
+
+def clear():
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        os.remove(path)
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render(collect()),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,42 @@
+"""add filter indexes
+
+B-tree indexes backing the name / gender / age filters of GET /actors and
+the release date filters of GET /movies.
+
+Revision ID: 3f1c2a9d8b7e
+Revises: a1f0c3e5b2d8
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d8b7e'
+down_revision = 'a1f0c3e5b2d8'
+branch_labels = None
+depends_on = None
+
+# IF NOT EXISTS, as manage.py create_db (db.create_all) creates them too
+INDEXES = [
+    ('ix_actors_name', 'actors', 'name{name_ops}'),
+    ('ix_actors_gender_age', 'actors', 'gender, age'),
+    ('ix_actors_age', 'actors', 'age'),
+    ('ix_movies_release_date', 'movies', 'release_date'),
+]
+
+
+def upgrade():
+    # prefix LIKE only uses the index with the pattern operator class
+    # when the database collation is not C
+    name_ops = ''
+    if op.get_bind().dialect.name == 'postgresql':
+        name_ops = ' varchar_pattern_ops'
+    for name, table, columns in INDEXES:
+        op.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+            name, table, columns.format(name_ops=name_ops)))
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.execute('DROP INDEX IF EXISTS %s' % name)
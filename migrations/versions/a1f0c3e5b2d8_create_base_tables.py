@@ -0,0 +1,45 @@
+"""create base tables
+
+actors, movies and the row_counts / table_versions bookkeeping tables,
+which used to be created by the application on import (db.create_all).
+
+Revision ID: a1f0c3e5b2d8
+Revises:
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1f0c3e5b2d8'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# IF NOT EXISTS, as the databases created before this revision (and by
+# manage.py create_db) already have them
+TABLES = [
+    ('actors', 'id {id_type} PRIMARY KEY, name VARCHAR NOT NULL,'
+     ' age INTEGER NOT NULL, gender VARCHAR NOT NULL'),
+    ('movies', 'id {id_type} PRIMARY KEY, title VARCHAR NOT NULL,'
+     ' release_date TIMESTAMP'),
+    ('row_counts', 'table_name VARCHAR PRIMARY KEY,'
+     ' total INTEGER NOT NULL'),
+    ('table_versions', 'table_name VARCHAR PRIMARY KEY,'
+     ' version INTEGER NOT NULL'),
+]
+
+
+def upgrade():
+    id_type = 'INTEGER'
+    if op.get_bind().dialect.name == 'postgresql':
+        id_type = 'SERIAL'
+    for table, columns in TABLES:
+        op.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (
+            table, columns.format(id_type=id_type)))
+
+
+def downgrade():
+    for table, columns in reversed(TABLES):
+        op.execute('DROP TABLE IF EXISTS %s' % table)
@@ -0,0 +1,50 @@
+"""add search documents
+
+Full-text index of actor names and movie titles used by GET /search: a
+tsvector column with a GIN index on Postgres, an FTS5 table on SQLite.
+The application keeps it current on every write; this revision creates
+it and fills it from the existing rows.
+
+Revision ID: b7d2e4f1a9c3
+Revises: 3f1c2a9d8b7e
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e4f1a9c3'
+down_revision = '3f1c2a9d8b7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(
+            "CREATE TABLE IF NOT EXISTS search_documents ("
+            " kind VARCHAR NOT NULL, ref_id INTEGER NOT NULL,"
+            " document TSVECTOR NOT NULL, PRIMARY KEY (kind, ref_id))")
+        op.execute(
+            "INSERT INTO search_documents (kind, ref_id, document)"
+            " SELECT 'actor', id, to_tsvector('simple', name) FROM actors"
+            " UNION ALL"
+            " SELECT 'movie', id, to_tsvector('simple', title) FROM movies"
+            " ON CONFLICT DO NOTHING")
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS ix_search_documents_document"
+            " ON search_documents USING GIN (document)")
+    else:
+        op.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_documents"
+            " USING fts5(document)")
+        # rowid packs the kind: id * 2 for actors, id * 2 + 1 for movies
+        op.execute(
+            "INSERT OR REPLACE INTO search_documents (rowid, document)"
+            " SELECT id * 2, name FROM actors"
+            " UNION ALL SELECT id * 2 + 1, title FROM movies")
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS search_documents")
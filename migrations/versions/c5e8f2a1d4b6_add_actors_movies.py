@@ -0,0 +1,38 @@
+"""add actors_movies
+
+Casting relation between actors and movies. The composite primary key
+(actor_id, movie_id) serves the movies of an actor and
+ix_actors_movies_movie_actor (movie_id, actor_id) the cast of a movie.
+
+Revision ID: c5e8f2a1d4b6
+Revises: b7d2e4f1a9c3
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8f2a1d4b6'
+down_revision = 'b7d2e4f1a9c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # manage.py create_db creates the table too (db.create_all)
+    op.execute(
+        "CREATE TABLE IF NOT EXISTS actors_movies ("
+        " actor_id INTEGER NOT NULL"
+        " REFERENCES actors (id) ON DELETE CASCADE,"
+        " movie_id INTEGER NOT NULL"
+        " REFERENCES movies (id) ON DELETE CASCADE,"
+        " PRIMARY KEY (actor_id, movie_id))")
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_actors_movies_movie_actor"
+        " ON actors_movies (movie_id, actor_id)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS ix_actors_movies_movie_actor")
+    op.execute("DROP TABLE IF EXISTS actors_movies")
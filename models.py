@@ -1,38 +1,248 @@
+import itertools
 import os
-from flask_sqlalchemy import SQLAlchemy
+import queue
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from datetime import datetime
-from flask_migrate import Migrate
+from sqlalchemy import (and_, event, exc, func, literal, orm, select,
+                        text)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import Pool, QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+from sqlalchemy.util import queue as sqla_queue
 
 database_path = os.environ.get('DATABASE_URL')
+replica_paths = [url.strip() for url in
+                 os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                 if url.strip()]
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+
+# group commit of single row inserts (GroupCommitWriter), off by default
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'false').lower() in (
+    '1', 'true', 'yes')
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 2))
+GROUP_COMMIT_MAX_ROWS = int(os.environ.get('GROUP_COMMIT_MAX_ROWS', 100))
+
+# connection pool, per worker process
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in (
+    '1', 'true', 'yes')
+
+###########################
+# READ REPLICA ROUTING
+###########################
+'''
+RoutingSession
+...sends the statements of read only requests to a replica
+
+a request handler marked with @use_replica reads from one of the
+DATABASE_REPLICA_URLS replicas, picked round robin once per request.
+Everything else goes to the primary: requests without the mark, flushes
+and INSERT / UPDATE / DELETE statements, and every statement issued after
+the request wrote something (mark_write()), so it reads its own writes.
+'''
+
+_replica_cycle = None
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replica = _replica_bind(self, clause)
+        if replica is not None:
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _replica_bind(session, clause):
+    if _replica_cycle is None or not has_request_context():
+        return None
+    if not g.get('db_read_only') or g.get('db_wrote'):
+        return None
+    if session._flushing or isinstance(clause, UpdateBase):
+        return None
+    if 'db_replica' not in g:
+        g.db_replica = next(_replica_cycle)
+    return db.get_engine(session.app, bind=g.db_replica)
+
+
+def use_replica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def mark_write():
+    if has_request_context():
+        g.db_wrote = True
+
+
+db = RoutingSQLAlchemy()
+
+
+@event.listens_for(db.session, 'before_flush')
+def _flush_is_a_write(session, flush_context, instances):
+    mark_write()
 
-db = SQLAlchemy()
 
 '''
 setup_db(app)
-...binds a flask application and a SQLAlchemy service
+...binds a flask application and a SQLAlchemy service, without connecting:
+the tables are created by create_schema in app.py (manage.py create_db) or
+the migrations
 
+replica_paths are bound as replica0, replica1, ... and used by the
+handlers marked with @use_replica
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=replica_paths):
+    global _replica_cycle
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS",
+                          engine_options(database_path))
+    replicas = ['replica%d' % i for i in range(len(replica_paths))]
+    app.config["SQLALCHEMY_BINDS"] = dict(zip(replicas, replica_paths))
+    _replica_cycle = itertools.cycle(replicas) if replicas else None
     db.app = app
     db.init_app(app)
-    db.create_all()
+    # drop a session left bound to a previously set up app
+    db.session.remove()
 
-    migrate = Migrate(app, db)
+
+###########################
+# CONNECTION POOL
+###########################
+'''
+TimedQueuePool
+...a QueuePool recording how long each checkout waited on its queue for a
+connection to be returned; opening a new connection is not part of it, so
+the wait is only the queueing behind other checkouts
+
+engine_options(database_path) configures it from the DB_POOL_* variables;
+SQLite keeps the pool SQLAlchemy picks for it, with pre-ping only.
+pool_stats() reports the pool usage of this worker, so the Postgres
+connection budget can be sized as workers * (size + max_overflow).
+'''
+
+_pool_waits = {'count': 0, 'total': 0.0, 'max': 0.0}
+_pool_waits_lock = threading.Lock()
+
+
+class TimedQueue(sqla_queue.Queue):
+    def get(self, block=True, timeout=None):
+        start = time.perf_counter()
+        try:
+            return super().get(block, timeout)
+        finally:
+            waited = time.perf_counter() - start
+            with _pool_waits_lock:
+                _pool_waits['count'] += 1
+                _pool_waits['total'] += waited
+                _pool_waits['max'] = max(_pool_waits['max'], waited)
+
+
+class TimedQueuePool(QueuePool):
+    def __init__(self, creator, pool_size=5, use_lifo=False, **kw):
+        super().__init__(creator, pool_size=pool_size, use_lifo=use_lifo,
+                         **kw)
+        self._pool = TimedQueue(pool_size, use_lifo=use_lifo)
+
+
+def engine_options(database_path):
+    options = {'pool_pre_ping': DB_POOL_PRE_PING}
+    if database_path and not database_path.startswith('sqlite'):
+        options.update(poolclass=TimedQueuePool,
+                       pool_size=DB_POOL_SIZE,
+                       max_overflow=DB_MAX_OVERFLOW,
+                       pool_timeout=DB_POOL_TIMEOUT,
+                       pool_recycle=DB_POOL_RECYCLE)
+    return options
+
+
+def pool_stats():
+    pool = db.get_engine().pool
+    with _pool_waits_lock:
+        waits = dict(_pool_waits)
+    stats = {
+        'pid': os.getpid(),
+        'pool': type(pool).__name__,
+        'wait_count': waits['count'],
+        'wait_seconds_total': waits['total'],
+        'wait_seconds_max': waits['max'],
+    }
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(),
+                     checked_in=pool.checkedin(),
+                     checked_out=pool.checkedout(),
+                     overflow=max(pool.overflow(), 0))
+    return stats
+
+
+'''
+dispose_engine()
+...drops the pooled connections of this process, called by the gunicorn
+pre_fork / post_fork hooks (gunicorn.conf.py) so a worker never shares a
+connection opened by the master
+
+connections also remember the pid that opened them, and one checked out
+in another process is discarded without being closed, so the inherited
+socket of the parent is left alone
+'''
+
+
+def dispose_engine():
+    if db.app is None:
+        return
+    for bind in [None] + list(db.app.config.get('SQLALCHEMY_BINDS') or ()):
+        db.get_engine(bind=bind).dispose()
+
+
+@event.listens_for(Pool, 'connect')
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid %s, attempting to check out '
+            'in pid %s' % (connection_record.info['pid'], pid))
 
 
 ###########################
 # ACTORS IN MOVIES RELATION Many to Many MODEL #
 ##########################
-# actors_movies = db.Table('actors_movies',
-#                          db.Column('actor_id', db.Integer,
-#                                    db.ForeignKey('actors.id')),
-#                          db.Column('movie_id', db.Integer,
-#                                    db.ForeignKey('movies.id'))
-#                          )
+# the primary key indexes actor -> movies, ix_actors_movies_movie_actor
+# indexes movie -> actors
+actors_movies = db.Table('actors_movies',
+                         db.Column('actor_id', db.Integer,
+                                   db.ForeignKey('actors.id',
+                                                 ondelete='CASCADE'),
+                                   primary_key=True),
+                         db.Column('movie_id', db.Integer,
+                                   db.ForeignKey('movies.id',
+                                                 ondelete='CASCADE'),
+                                   primary_key=True),
+                         db.Index('ix_actors_movies_movie_actor',
+                                  'movie_id', 'actor_id')
+                         )
 
 ########################
 # ACTOR MODEL
@@ -45,9 +255,16 @@ class Actor(db.Model):
     name = db.Column(db.String(), nullable=False)
     age = db.Column(db.Integer, nullable=False)
     gender = db.Column(db.String(), nullable=False)
-    # actor_in_movies = db.relationship(
-    #     'Movie', secondary=actors_movies, backref=db.backref('movies_actors',
-    #                                                          lazy='dynamic'))
+    # same indexes as migrations/versions/3f1c2a9d8b7e_add_filter_indexes.py
+    __table_args__ = (
+        db.Index('ix_actors_name', 'name',
+                 postgresql_ops={'name': 'varchar_pattern_ops'}),
+        db.Index('ix_actors_gender_age', 'gender', 'age'),
+        db.Index('ix_actors_age', 'age'),
+    )
+    actor_in_movies = db.relationship(
+        'Movie', secondary=actors_movies, order_by='Movie.id',
+        back_populates='movies_actors')
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -82,6 +299,12 @@ class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(), nullable=False)
     release_date = db.Column(db.DateTime(), default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_movies_release_date', 'release_date'),
+    )
+    movies_actors = db.relationship(
+        'Actor', secondary=actors_movies, order_by='Actor.id',
+        back_populates='actor_in_movies')
 
     def __init__(self, title):
         self.title = title
@@ -103,3 +326,579 @@ class Movie(db.Model):
             'title': self.title,
             'release_date': self.release_date,
         }
+
+
+###########################
+# ROW COUNTERS
+###########################
+'''
+RowCount
+...one row per counted table holding its number of rows
+
+the counters are updated by the after_insert / after_delete mapper events,
+on the flush connection, so they commit or roll back together with the
+rows they count, and row_count(model) is a primary key lookup instead of
+loading or scanning the table
+
+the counter rows are created with the schema (create_schema, migration
+e3a7c9d1f5b2); the seeding locks the table against writers, so an insert
+running meanwhile is either counted or bumps the new row, never lost
+'''
+
+
+class RowCount(db.Model):
+    __tablename__ = 'row_counts'
+    table_name = db.Column(db.String(), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+
+COUNTED_MODELS = (Actor, Movie)
+
+
+def bump_row_count(connection, table_name, delta):
+    row_counts = RowCount.__table__
+    connection.execute(
+        row_counts.update()
+        .where(row_counts.c.table_name == table_name)
+        .values(total=row_counts.c.total + delta))
+
+
+def _count_insert(mapper, connection, target):
+    bump_row_count(connection, target.__tablename__, 1)
+
+
+def _count_delete(mapper, connection, target):
+    bump_row_count(connection, target.__tablename__, -1)
+
+
+for model in COUNTED_MODELS:
+    event.listen(model, 'after_insert', _count_insert)
+    event.listen(model, 'after_delete', _count_delete)
+
+
+def _seed_row_count(model):
+    mark_write()
+    row_counts = RowCount.__table__
+    counted = select([literal(model.__tablename__), func.count()]).select_from(
+        model.__table__)
+    try:
+        if db.session.connection().dialect.name == 'postgresql':
+            # an insert in flight has bumped no counter (there was no row
+            # to update) and its row is not visible to COUNT(*) yet: wait
+            # for it, and keep new ones out until the counter is committed.
+            # SQLite serializes writers already.
+            db.session.execute('LOCK TABLE %s IN SHARE MODE'
+                               % model.__tablename__)
+        db.session.execute(row_counts.insert().from_select(
+            ['table_name', 'total'], counted))
+        db.session.commit()
+    except IntegrityError:
+        # seeded concurrently by another worker
+        db.session.rollback()
+
+
+def seed_row_counts():
+    seeded = {name for (name,) in db.session.query(RowCount.table_name)}
+    for model in COUNTED_MODELS:
+        if model.__tablename__ not in seeded:
+            _seed_row_count(model)
+
+
+def row_count(model):
+    total = db.session.query(RowCount.total).filter(
+        RowCount.table_name == model.__tablename__).scalar()
+    if total is None:
+        _seed_row_count(model)
+        return row_count(model)
+    return total
+
+
+###########################
+# TABLE VERSIONS
+###########################
+'''
+TableVersion
+...a version number per table, increased by every flush that inserts,
+updates or deletes rows of that table
+
+the bump runs on the flush connection, so a new version is only visible
+once the change it stands for is committed, and every worker sees the
+same number. The GET handlers derive their ETag from it.
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+    table_name = db.Column(db.String(), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+
+VERSIONED_MODELS = (Actor, Movie)
+_table_change_listeners = []
+
+
+def on_table_change(listener):
+    """Registers a callable run with the table name whenever a version
+    of that table is bumped (i.e. to drop cached copies of it).
+    """
+    _table_change_listeners.append(listener)
+
+
+_row_change_listeners = []
+
+
+def on_rows_change(listener):
+    """Registers listener(connection, model, action, rows), called on the
+    writing connection, inside its transaction, whenever Actor or Movie
+    rows are inserted, updated or deleted (action), through the ORM or the
+    helpers below. rows are dicts of column values, only the id for
+    deletes.
+    """
+    _row_change_listeners.append(listener)
+
+
+def rows_changed(connection, model, action, rows):
+    for listener in _row_change_listeners:
+        listener(connection, model, action, rows)
+
+
+def _row_values(target):
+    return {column.key: getattr(target, column.key)
+            for column in target.__mapper__.column_attrs}
+
+
+def _insert_changed(mapper, connection, target):
+    rows_changed(connection, type(target), 'insert', [_row_values(target)])
+
+
+def _update_changed(mapper, connection, target):
+    rows_changed(connection, type(target), 'update', [_row_values(target)])
+
+
+def _delete_changed(mapper, connection, target):
+    rows_changed(connection, type(target), 'delete', [{'id': target.id}])
+
+
+# an upsert, not an UPDATE: a write running while a reader seeds the row
+# lazily would update nothing and leave the seeded version (and the ETags
+# and cache entries built on it) current after the write commits. With the
+# upsert the write creates the row itself, and the seeding insert waits
+# for it and fails on the primary key. Postgres and SQLite (3.24+) both
+# accept ON CONFLICT.
+_BUMP_TABLE_VERSION = text(
+    'INSERT INTO table_versions (table_name, version) VALUES (:table_name, 2)'
+    ' ON CONFLICT (table_name)'
+    ' DO UPDATE SET version = table_versions.version + 1')
+
+
+def bump_table_version(connection, table_name):
+    connection.execute(_BUMP_TABLE_VERSION, table_name=table_name)
+    for listener in _table_change_listeners:
+        listener(table_name)
+
+
+for model in VERSIONED_MODELS:
+    event.listen(model, 'after_insert', _insert_changed)
+    event.listen(model, 'after_update', _update_changed)
+    event.listen(model, 'after_delete', _delete_changed)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _version_flushed_tables(session, flush_context):
+    changed = set(session.new) | set(session.deleted) | {
+        obj for obj in session.dirty if session.is_modified(obj)}
+    tables = {obj.__tablename__ for obj in changed
+              if isinstance(obj, VERSIONED_MODELS)}
+    for table_name in sorted(tables):
+        bump_table_version(session.connection(), table_name)
+
+
+def _seed_table_version(model):
+    mark_write()
+    try:
+        db.session.add(TableVersion(table_name=model.__tablename__,
+                                    version=1))
+        db.session.commit()
+    except IntegrityError:
+        # seeded concurrently by another worker
+        db.session.rollback()
+
+
+def seed_table_versions():
+    seeded = {name for (name,) in db.session.query(TableVersion.table_name)}
+    for model in VERSIONED_MODELS:
+        if model.__tablename__ not in seeded:
+            _seed_table_version(model)
+
+
+def table_version(model):
+    version = db.session.query(TableVersion.version).filter(
+        TableVersion.table_name == model.__tablename__).scalar()
+    if version is None:
+        _seed_table_version(model)
+        return table_version(model)
+    return version
+
+
+###########################
+# BULK INSERT
+###########################
+'''
+insert_many(model, rows)
+...inserts rows (dicts of column values) in a single transaction and
+returns their new ids, in the order of rows
+
+the rows go in batches of BULK_BATCH_SIZE
+    on Postgres each batch is one INSERT ... VALUES (...), (...) RETURNING id
+    on SQLite each batch is an executemany; the database lock is held
+    until commit, so the new ids are the highest ids of the table
+the row counter and table version are bumped once for the whole insert
+'''
+
+
+def insert_many(model, rows, batch_size=BULK_BATCH_SIZE):
+    if not rows:
+        return []
+    mark_write()
+    try:
+        ids = insert_rows(db.session.connection(), model, rows, batch_size)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def insert_rows(connection, model, rows, batch_size=BULK_BATCH_SIZE):
+    """insert_many without the commit, in the transaction of connection."""
+    table = model.__table__
+    ids = []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if connection.dialect.name == 'postgresql':
+            result = connection.execute(
+                table.insert().values(batch).returning(table.c.id))
+            batch_ids = [row[0] for row in result]
+        else:
+            connection.execute(table.insert(), batch)
+            result = connection.execute(
+                select([table.c.id]).order_by(table.c.id.desc())
+                .limit(len(batch)))
+            batch_ids = sorted(row[0] for row in result)
+        rows_changed(connection, model, 'insert', [
+            dict(row, id=id) for row, id in zip(batch, batch_ids)])
+        ids.extend(batch_ids)
+    bump_row_count(connection, table.name, len(ids))
+    bump_table_version(connection, table.name)
+    return ids
+
+
+###########################
+# GROUP COMMIT
+###########################
+'''
+GroupCommitWriter(app)
+...commits the single row inserts of concurrent requests together
+
+insert(model, values) queues the row and blocks until it is committed,
+then returns its id, or raises the error of that row. A writer thread
+takes the first queued row, waits up to GROUP_COMMIT_WINDOW_MS for more
+(at most GROUP_COMMIT_MAX_ROWS rows) and inserts them all in one
+transaction through insert_rows, so the primary syncs once for the group
+and row counts, table versions and the search index follow as for
+insert_many. When that transaction fails, every row is retried in a
+transaction of its own and only the rows at fault get an error.
+
+create_app sets one up per app when GROUP_COMMIT is true.
+'''
+
+
+class PendingRow:
+    def __init__(self, model, values):
+        self.model = model
+        self.values = values
+        self.id = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitWriter:
+    def __init__(self, app, window=GROUP_COMMIT_WINDOW_MS / 1000.0,
+                 max_rows=GROUP_COMMIT_MAX_ROWS):
+        self.app = app
+        self.window = window
+        self.max_rows = max_rows
+        self._queue = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def insert(self, model, values):
+        row = PendingRow(model, values)
+        self._start()
+        self._queue.put(row)
+        row.done.wait()
+        if row.error is not None:
+            raise row.error
+        return row.id
+
+    def _start(self):
+        # on first use in each process: a forked worker has no thread
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, name='group-commit',
+                                 daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as error:
+                for row in batch:
+                    if row.id is None and row.error is None:
+                        row.error = error
+            for row in batch:
+                row.done.set()
+
+    def _write(self, batch):
+        with self.app.app_context():
+            try:
+                self._commit(batch)
+            except Exception:
+                db.session.rollback()
+                for row in batch:
+                    try:
+                        self._commit([row])
+                    except Exception as error:
+                        db.session.rollback()
+                        row.id, row.error = None, error
+            finally:
+                db.session.remove()
+
+    def _commit(self, rows):
+        connection = db.session.connection()
+        by_model = {}
+        for row in rows:
+            by_model.setdefault(row.model, []).append(row)
+        for model, model_rows in by_model.items():
+            ids = insert_rows(connection, model,
+                              [row.values for row in model_rows])
+            for row, id in zip(model_rows, ids):
+                row.id = id
+        db.session.commit()
+
+
+###########################
+# SINGLE STATEMENT MUTATIONS
+###########################
+'''
+update_by_id(model, id, values)
+...updates the row of model with the given id and returns it, or None
+when there is no such row
+
+    on Postgres this is one UPDATE ... RETURNING statement
+    on SQLite the UPDATE is followed by a primary key SELECT of the row,
+    only when the UPDATE matched it (rowcount), in the same transaction
+'''
+
+
+def update_by_id(model, id, values):
+    table = model.__table__
+    statement = table.update().where(table.c.id == id).values(**values)
+    mark_write()
+    connection = db.session.connection()
+    try:
+        if connection.dialect.name == 'postgresql':
+            row = connection.execute(statement.returning(*table.c)).first()
+        else:
+            row = None
+            if connection.execute(statement).rowcount:
+                row = connection.execute(
+                    table.select().where(table.c.id == id)).first()
+        if row is not None:
+            rows_changed(connection, model, 'update', [dict(row)])
+            bump_table_version(connection, table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return row
+
+
+'''
+delete_by_id(model, id)
+...deletes the row of model with the given id in one DELETE statement and
+returns whether there was such a row (rowcount)
+'''
+
+
+def delete_by_id(model, id):
+    table = model.__table__
+    mark_write()
+    connection = db.session.connection()
+    try:
+        # SQLite does not enforce ON DELETE CASCADE by default
+        linked_column, other = LINKS[model]
+        unlinked = connection.execute(actors_movies.delete().where(
+            linked_column == id)).rowcount
+        deleted = connection.execute(
+            table.delete().where(table.c.id == id)).rowcount
+        if deleted:
+            rows_changed(connection, model, 'delete', [{'id': id}])
+            bump_row_count(connection, table.name, -deleted)
+            bump_table_version(connection, table.name)
+        if unlinked:
+            bump_table_version(connection, other.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return bool(deleted)
+
+
+###########################
+# CASTING
+###########################
+'''
+link(actor_id, movie_id) / unlink(actor_id, movie_id)
+...add or remove an actor from the cast of a movie, return False when the
+actor or the movie does not exist (link) or was not cast (unlink)
+
+both tables change version, as either list can include the other
+'''
+
+LINKS = {Actor: (actors_movies.c.actor_id, Movie),
+         Movie: (actors_movies.c.movie_id, Actor)}
+
+
+def link(actor_id, movie_id):
+    if db.session.query(Actor.id).filter(Actor.id == actor_id).scalar() \
+            is None or db.session.query(Movie.id).filter(
+                Movie.id == movie_id).scalar() is None:
+        return False
+    mark_write()
+    connection = db.session.connection()
+    try:
+        linked = connection.execute(select([actors_movies.c.actor_id]).where(
+            (actors_movies.c.actor_id == actor_id) &
+            (actors_movies.c.movie_id == movie_id))).first()
+        if linked is None:
+            connection.execute(actors_movies.insert(), actor_id=actor_id,
+                               movie_id=movie_id)
+            bump_table_version(connection, Actor.__tablename__)
+            bump_table_version(connection, Movie.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return True
+
+
+def unlink(actor_id, movie_id):
+    mark_write()
+    connection = db.session.connection()
+    try:
+        unlinked = connection.execute(actors_movies.delete().where(
+            (actors_movies.c.actor_id == actor_id) &
+            (actors_movies.c.movie_id == movie_id))).rowcount
+        if unlinked:
+            bump_table_version(connection, Actor.__tablename__)
+            bump_table_version(connection, Movie.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return bool(unlinked)
+
+
+'''
+cast_of(model, id)
+...condition selecting the rows linked to the model row with the given id,
+i.e. cast_of(Movie, 3) selects the actors of movie 3; a semi-join on one
+of the association table indexes
+'''
+
+
+def cast_of(model, id):
+    linked_column, other = LINKS[model]
+    other_column, _ = LINKS[other]
+    return other.id.in_(select([other_column]).where(linked_column == id))
+
+
+###########################
+# FILTERS
+###########################
+'''
+starts_with(column, prefix)
+...a prefix match that can use the B-tree index of column
+
+    Postgres: LIKE 'prefix%' (the index uses varchar_pattern_ops)
+    SQLite: GLOB 'prefix*', which unlike LIKE is case sensitive and so
+    can use a plain index
+'''
+
+
+def starts_with(column, prefix):
+    if db.engine.dialect.name == 'sqlite':
+        for special in '[*?':
+            prefix = prefix.replace(special, '[%s]' % special)
+        return column.op('GLOB')(prefix + '*')
+    return column.startswith(prefix, autoescape=True)
+
+
+###########################
+# READ PATH
+###########################
+'''
+select_rows(model, fields, *criteria)
+...Core SELECT of the fields columns of model matching criteria, in id
+order; read_rows() runs it and returns the result, whose rows come
+straight from the cursor: no model instance, no identity map, nothing
+for the session to track or flush
+stream=True reads it through a server side cursor
+
+format_row(row, fields)
+...the dict of fields of a row (a Core row or an instance); with every
+column it is the same as Model.format()
+
+load_fields(model, fields, options)
+...ORM query that only loads fields, for the eager loads (options) that
+need instances
+'''
+
+
+def model_fields(model):
+    return model.__table__.columns.keys()
+
+
+def select_rows(model, fields, *criteria):
+    table = model.__table__
+    return select([table.c[field] for field in fields]).where(
+        and_(*criteria)).order_by(table.c.id)
+
+
+def read_rows(statement, stream=False):
+    if stream:
+        statement = statement.execution_options(stream_results=True)
+    return db.session.execute(statement)
+
+
+def format_row(row, fields):
+    return {field: getattr(row, field) for field in fields}
+
+
+def load_fields(model, fields, options=()):
+    return model.query.options(orm.load_only(*fields), *options)
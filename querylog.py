@@ -0,0 +1,168 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from flask import _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+QUERY_BUDGET_STRICT = os.environ.get(
+    'QUERY_BUDGET_STRICT', 'false').lower() == 'true'
+
+logger = logging.getLogger('querylog')
+
+'''
+Query log
+
+init_app(app) follows the SQL statements of every request of the app,
+from the cursor events of every engine:
+
+- counts the statements and the rows they returned or changed (rows as
+  the driver reports them in cursor.rowcount: psycopg2 does for SELECT,
+  sqlite3 only for INSERT, UPDATE and DELETE)
+- logs every statement slower than SLOW_QUERY_MS (default 100) with the
+  route and the normalized SQL
+- warns once per request and statement shape when the same shape runs
+  N_PLUS_ONE_THRESHOLD (default 5) times, the mark of an N+1 loop
+- checks the budget of the route, declared with @query_budget(n) right
+  under @app.route (n may be a function, called after the handler in the
+  request context, for routes whose cost grows with the request): going
+  over it is a warning, or with the app config
+  QUERY_BUDGET_STRICT (env QUERY_BUDGET_STRICT, default false; the tests
+  turn it on) a QueryBudgetExceeded error that fails the request
+
+stats() returns the count of the current request.
+'''
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(statements):
+    def query_budget_decorator(f):
+        f.query_budget = statements
+        return f
+    return query_budget_decorator
+
+
+'''
+normalize(statement)
+...the shape of a statement: literals become ?, IN lists of any length
+become IN (?) and the whitespace collapses, so the statements of one loop
+compare equal
+'''
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)'
+_LISTS = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)' % (
+    _PLACEHOLDER, _PLACEHOLDER))
+_SPACES = re.compile(r'\s+')
+_shapes = {}
+
+
+def normalize(statement):
+    shape = _shapes.get(statement)
+    if shape is None:
+        shape = _SPACES.sub(' ', statement).strip()
+        shape = _LITERALS.sub('?', shape)
+        shape = _LISTS.sub('(?)', shape)
+        if len(_shapes) < 1000:
+            _shapes[statement] = shape
+    return shape
+
+
+'''
+request tracking
+...the thread's request keeps its route, budget, statement and row counts
+and the count of every statement shape, set up by before_request and
+checked by after_request
+'''
+
+_request = threading.local()
+
+
+class RequestStats:
+    def __init__(self, route, budget):
+        self.route = route
+        self.budget = budget
+        self.statements = 0
+        self.rows = 0
+        self.shapes = Counter()
+
+
+def stats():
+    return getattr(_request, 'stats', None)
+
+
+def _start_request():
+    current = _request_ctx_stack.top
+    rule = current.request.url_rule
+    view = current.app.view_functions.get(current.request.endpoint)
+    _request.stats = RequestStats(
+        rule.rule if rule is not None else '<unmatched>',
+        getattr(view, 'query_budget', None))
+
+
+def _check_budget(response):
+    request_stats = getattr(_request, 'stats', None)
+    if request_stats is None:
+        return response
+    _request.stats = None
+    current = _request_ctx_stack.top
+    budget = request_stats.budget
+    if callable(budget):
+        budget = budget()
+    if budget is None or request_stats.statements <= budget:
+        return response
+    message = '%s %s ran %d statements, over its budget of %d' % (
+        current.request.method, request_stats.route,
+        request_stats.statements, budget)
+    if current.app.config.get('QUERY_BUDGET_STRICT', QUERY_BUDGET_STRICT):
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+    return response
+
+
+def _teardown_request(error):
+    _request.stats = None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('querylog_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get('querylog_start')
+    if not starts:
+        return
+    elapsed = (time.perf_counter() - starts.pop()) * 1000
+    request_stats = getattr(_request, 'stats', None)
+    route = request_stats.route if request_stats else '<none>'
+    if elapsed >= SLOW_QUERY_MS:
+        logger.warning('slow query (%.1f ms) on %s: %s', elapsed, route,
+                       normalize(statement))
+    if request_stats is None:
+        return
+    request_stats.statements += 1
+    if cursor.rowcount > 0:
+        request_stats.rows += cursor.rowcount
+    shape = normalize(statement)
+    request_stats.shapes[shape] += 1
+    if request_stats.shapes[shape] == N_PLUS_ONE_THRESHOLD:
+        logger.warning('possible N+1 on %s: %d times %s', route,
+                       N_PLUS_ONE_THRESHOLD, shape)
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_check_budget)
+    app.teardown_request(_teardown_request)
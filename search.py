@@ -0,0 +1,168 @@
+import re
+from sqlalchemy import text
+from models import (db, model_fields, on_rows_change, read_rows,
+                    select_rows, Actor, Movie)
+from serializers import serializer
+
+SEARCH_MAX_TERMS = 8
+
+'''
+Full-text search over actor names and movie titles
+
+Both are kept in one search_documents index, a tsvector column with a GIN
+index on Postgres and an FTS5 virtual table on SQLite. The index is
+updated incrementally, in the transaction of the write, from the row
+change hook of models.py (ORM flushes, bulk inserts, single statement
+updates and deletes), so it is never rebuilt once created.
+
+A document is identified by (kind, id); on SQLite both are packed in the
+FTS5 rowid (id * 2 + kind) so updates and deletes are rowid lookups.
+'''
+
+KINDS = {Actor: ('actor', 'name', 0), Movie: ('movie', 'title', 1)}
+MODELS = {kind: model for model, (kind, column, code) in KINDS.items()}
+
+
+def search_terms(q):
+    return re.findall(r'\w+', q.lower())[:SEARCH_MAX_TERMS]
+
+
+class PostgresSearchIndex:
+    def create(self, connection):
+        created = not connection.dialect.has_table(connection,
+                                                   'search_documents')
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS search_documents ("
+            " kind VARCHAR NOT NULL, ref_id INTEGER NOT NULL,"
+            " document TSVECTOR NOT NULL, PRIMARY KEY (kind, ref_id))"))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_search_documents_document"
+            " ON search_documents USING GIN (document)"))
+        return created
+
+    def upsert(self, connection, kind, documents):
+        connection.execute(text(
+            "INSERT INTO search_documents (kind, ref_id, document)"
+            " VALUES (:kind, :id, to_tsvector('simple', :text))"
+            " ON CONFLICT (kind, ref_id)"
+            " DO UPDATE SET document = EXCLUDED.document"),
+            [{'kind': kind, 'id': id, 'text': value}
+             for id, value in documents])
+
+    def remove(self, connection, kind, ids):
+        connection.execute(text(
+            "DELETE FROM search_documents"
+            " WHERE kind = :kind AND ref_id = :id"),
+            [{'kind': kind, 'id': id} for id in ids])
+
+    def search(self, connection, terms, limit, offset):
+        query = ' & '.join(term + ':*' for term in terms)
+        result = connection.execute(text(
+            "SELECT kind, ref_id, ts_rank(document, tsq) AS score"
+            " FROM search_documents, to_tsquery('simple', :query) tsq"
+            " WHERE document @@ tsq"
+            " ORDER BY score DESC, kind, ref_id"
+            " LIMIT :limit OFFSET :offset"),
+            query=query, limit=limit, offset=offset)
+        return [(kind, ref_id, score) for kind, ref_id, score in result]
+
+
+class SqliteSearchIndex:
+    def create(self, connection):
+        created = not connection.dialect.has_table(connection,
+                                                   'search_documents')
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_documents"
+            " USING fts5(document)"))
+        return created
+
+    def upsert(self, connection, kind, documents):
+        code = KINDS[MODELS[kind]][2]
+        connection.execute(text(
+            "INSERT OR REPLACE INTO search_documents (rowid, document)"
+            " VALUES (:rowid, :text)"),
+            [{'rowid': id * 2 + code, 'text': value}
+             for id, value in documents])
+
+    def remove(self, connection, kind, ids):
+        code = KINDS[MODELS[kind]][2]
+        connection.execute(text(
+            "DELETE FROM search_documents WHERE rowid = :rowid"),
+            [{'rowid': id * 2 + code} for id in ids])
+
+    def search(self, connection, terms, limit, offset):
+        query = ' '.join('"%s"*' % term for term in terms)
+        result = connection.execute(text(
+            "SELECT rowid, bm25(search_documents) AS rank"
+            " FROM search_documents WHERE search_documents MATCH :query"
+            " ORDER BY rank, rowid LIMIT :limit OFFSET :offset"),
+            query=query, limit=limit, offset=offset)
+        kinds = {code: kind for kind, column, code in KINDS.values()}
+        return [(kinds[rowid % 2], rowid // 2, -rank)
+                for rowid, rank in result]
+
+
+def search_index(connection):
+    if connection.dialect.name == 'postgresql':
+        return PostgresSearchIndex()
+    return SqliteSearchIndex()
+
+
+def _index_changed_rows(connection, model, action, rows):
+    kind, column, code = KINDS[model]
+    index = search_index(connection)
+    if action == 'delete':
+        index.remove(connection, kind, [row['id'] for row in rows])
+    else:
+        index.upsert(connection, kind,
+                     [(row['id'], row[column]) for row in rows])
+
+
+on_rows_change(_index_changed_rows)
+
+
+'''
+create_search_index()
+...creates the search index when it does not exist yet, and then fills it
+once from the existing rows
+'''
+
+
+def create_search_index():
+    connection = db.session.connection()
+    index = search_index(connection)
+    if index.create(connection):
+        for model, (kind, column, code) in KINDS.items():
+            table = model.__table__
+            rows = connection.execute(
+                table.select().with_only_columns(
+                    [table.c.id, table.c[column]])).fetchall()
+            if rows:
+                index.upsert(connection, kind, rows)
+    db.session.commit()
+
+
+'''
+search(q, limit, offset)
+...returns the actors and movies matching every word of q (as a prefix),
+best match first, as (kind, score, formatted row)
+'''
+
+
+def search(q, limit, offset):
+    terms = search_terms(q)
+    if not terms:
+        return []
+    connection = db.session.connection()
+    hits = search_index(connection).search(connection, terms, limit, offset)
+
+    rows = {}
+    for kind, model in MODELS.items():
+        ids = [ref_id for hit_kind, ref_id, score in hits if hit_kind == kind]
+        if ids:
+            serialize = serializer(model)
+            for row in read_rows(select_rows(model, model_fields(model),
+                                             model.id.in_(ids))):
+                rows[kind, row.id] = serialize(row)
+    return [(kind, score, rows[kind, ref_id])
+            for kind, ref_id, score in hits if (kind, ref_id) in rows]
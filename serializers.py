@@ -0,0 +1,108 @@
+import json
+from datetime import datetime, timezone
+from flask import Response
+from sqlalchemy import Date, DateTime
+from models import model_fields, Actor, Movie
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON serialization
+
+serializer(model, fields) builds, once per model and fieldset, the
+function that turns a row (a Core row or a model instance) into a JSON
+ready dict. The value conversions are picked from the column types when
+it is built, so a DateTime column is formatted by one isoformat() call
+instead of going through the fallback of a generic encoder.
+
+dumps() encodes a document with orjson when it is installed and with the
+json module otherwise. Both write compact JSON with sorted keys and
+unescaped UTF-8, so a document always encodes to the same bytes, which the
+ETags and the response cache rely on.
+'''
+
+
+def iso_datetime(value):
+    """DateTime columns: 2020-05-08T10:33:30.000000Z (stored naive, in
+    UTC)"""
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec='microseconds') + 'Z'
+
+
+def parse_datetime(value):
+    """The naive UTC datetime of an ISO 8601 date or date-time, as stored;
+    accepts the output of iso_datetime (Z) and other UTC offsets."""
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def iso_date(value):
+    return None if value is None else value.isoformat()
+
+
+def column_converter(column):
+    if isinstance(column.type, DateTime):
+        return iso_datetime
+    if isinstance(column.type, Date):
+        return iso_date
+    return None
+
+
+_serializers = {}
+
+
+def serializer(model, fields=None):
+    fields = tuple(fields or model_fields(model))
+    serialize = _serializers.get((model, fields))
+    if serialize is None:
+        serialize = _serializers[model, fields] = build_serializer(
+            model, fields)
+    return serialize
+
+
+def build_serializer(model, fields):
+    columns = model.__table__.columns
+    plain = [field for field in fields
+             if column_converter(columns[field]) is None]
+    converted = [(field, column_converter(columns[field]))
+                 for field in fields
+                 if column_converter(columns[field]) is not None]
+
+    def serialize(row):
+        result = {field: getattr(row, field) for field in plain}
+        for field, convert in converted:
+            result[field] = convert(getattr(row, field))
+        return result
+
+    return serialize
+
+
+def dumps_stdlib(document):
+    return json.dumps(document, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+def dumps_orjson(document):
+    return orjson.dumps(document, option=orjson.OPT_SORT_KEYS)
+
+
+dumps = dumps_orjson if orjson is not None else dumps_stdlib
+
+
+def json_response(document, status=200):
+    return Response(dumps(document), status, mimetype='application/json')
+
+
+# full rows are the common case, build them up front
+for model in (Actor, Movie):
+    serializer(model)
@@ -0,0 +1,72 @@
+import os
+from flask import Response, request, stream_with_context
+from models import model_fields, read_rows, select_rows
+from serializers import dumps, serializer
+
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+'''
+Streaming list responses
+
+A list request is streamed when it asks for ?stream=1 or prefers
+application/x-ndjson in its Accept header. Rows are read through a server
+side cursor STREAM_BATCH_SIZE at a time, as plain rows (models.read_rows),
+and sent as soon as each batch is encoded, so memory stays flat however
+big the table is.
+'''
+
+
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def wants_stream():
+    stream = request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+    return stream or wants_ndjson()
+
+
+'''
+stream_list(model, key, after)
+...streams every row of model with id > after matching filters, in id
+order, restricted to fields when given
+
+    as NDJSON (one formatted row per line) when the client accepts it
+    otherwise as the same document as the paginated list,
+    {"success": true, <key>: [...]}, without next_cursor
+'''
+
+
+def stream_list(model, key, after=0, filters=(), fields=None):
+    fields = fields or model_fields(model)
+    serialize = serializer(model, fields)
+
+    def batches():
+        rows = read_rows(select_rows(model, fields, model.id > after,
+                                     *filters), stream=True)
+        while True:
+            batch = rows.fetchmany(STREAM_BATCH_SIZE)
+            if not batch:
+                break
+            yield [dumps(serialize(row)) for row in batch]
+
+    if wants_ndjson():
+        def generate():
+            for batch in batches():
+                yield b'\n'.join(batch) + b'\n'
+
+        return Response(stream_with_context(generate()),
+                        mimetype=NDJSON_MIMETYPE)
+
+    def generate():
+        yield b'{"success":true,"%s":[' % key.encode('utf-8')
+        separator = b''
+        for batch in batches():
+            yield separator + b','.join(batch)
+            separator = b','
+        yield b']}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
@@ -1,9 +1,34 @@
+import asyncio
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import json
+import zlib
+from datetime import datetime
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
-from app import create_app
-from models import setup_db
+from sqlalchemy import create_engine, event, exc
+import metrics
+import models
+import querylog
+import serializers
+from app import create_app, create_schema, warm_up
+from models import (setup_db, db, engine_options, row_count, table_version,
+                    Actor, Movie, RowCount, TableVersion, TimedQueuePool)
+from cache import MemoryBackend, response_cache
+from auth import (AuthError, JWKSKeyStore, VerifiedToken, VerifiedTokenCache,
+                  check_permissions)
+import asyncdb
+import compression
+import importer
+try:
+    import asgi
+except ImportError:
+    asgi = None
 
 
 class CastingAgencyTestCase(unittest.TestCase):
@@ -283,7 +308,1208 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "Unauthorized Error")
-        
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """Key store behaviour, using a fake clock and key endpoint."""
+
+    def setUp(self):
+        self.now = 0
+        self.fetches = 0
+        self.jwks = {'keys': [{'kty': 'RSA', 'kid': 'k1', 'use': 'sig',
+                               'n': 'n1', 'e': 'AQAB'}]}
+
+        def fetch():
+            self.fetches += 1
+            return self.jwks
+
+        self.store = JWKSKeyStore('https://example/jwks.json', ttl=100,
+                                  refresh_margin=10,
+                                  min_refresh_interval=5,
+                                  fetch=fetch, clock=lambda: self.now)
+
+    def test_cached_key_skips_network(self):
+        for _ in range(3):
+            self.assertEqual(self.store.get_key('k1')['n'], 'n1')
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.store.stats()['hits'], 3)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        self.store.get_key('k1')
+        self.now = 10
+        self.assertIsNone(self.store.get_key('k2'))
+        self.assertIsNone(self.store.get_key('k2'))
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.store.stats()['misses'], 2)
+
+        self.jwks['keys'].append({'kty': 'RSA', 'kid': 'k2', 'use': 'sig',
+                                  'n': 'n2', 'e': 'AQAB'})
+        self.now = 16
+        self.assertEqual(self.store.get_key('k2')['n'], 'n2')
+        self.assertEqual(self.fetches, 3)
+
+    def test_refreshes_in_background_before_expiry(self):
+        self.store.get_key('k1')
+        self.now = 95
+        self.assertEqual(self.store.get_key('k1')['n'], 'n1')
+        self.store._refresh_thread.join()
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.store.stats()['refreshes'], 2)
+
+    def test_failed_refresh_keeps_serving_old_keys(self):
+        self.store.get_key('k1')
+        self.jwks = None
+        self.now = 200
+        self.assertEqual(self.store.get_key('k1')['n'], 'n1')
+        self.assertEqual(self.store.stats()['refresh_failures'], 1)
+
+    def test_rotation_notifies_listeners(self):
+        rotations = []
+        self.store.on_rotate(lambda: rotations.append(True))
+        self.store.get_key('k1')
+        self.now = 100
+        self.store.get_key('k1')
+        self.assertEqual(rotations, [])
+
+        self.jwks = {'keys': [{'kty': 'RSA', 'kid': 'k2', 'use': 'sig',
+                               'n': 'n2', 'e': 'AQAB'}]}
+        self.now = 200
+        self.store.get_key('k2')
+        self.assertEqual(rotations, [True])
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.cache = VerifiedTokenCache(maxsize=2, clock=lambda: self.now)
+        self.payload = {'sub': 'a', 'exp': 1100,
+                        'permissions': ['get:actors']}
+
+    def test_entry_expires_with_token(self):
+        self.cache.put('token-a', self.payload)
+        self.assertEqual(self.cache.get('token-a').payload, self.payload)
+        self.now = 1100
+        self.assertIsNone(self.cache.get('token-a'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        for token in ('token-a', 'token-b'):
+            self.cache.put(token, self.payload)
+        self.cache.get('token-a')
+        self.cache.put('token-c', self.payload)
+        self.assertIsNotNone(self.cache.get('token-a'))
+        self.assertIsNone(self.cache.get('token-b'))
+
+    def test_tokens_without_exp_are_not_cached(self):
+        self.cache.put('token-a', {'permissions': []})
+        self.assertIsNone(self.cache.get('token-a'))
+
+    def test_permissions_are_precomputed(self):
+        entry = self.cache.put('token-a', self.payload)
+        self.assertEqual(entry.permissions, frozenset(['get:actors']))
+        self.assertTrue(check_permissions('get:actors', entry.payload,
+                                          entry.permissions))
+        with self.assertRaises(AuthError):
+            check_permissions('delete:actors', entry.payload,
+                              entry.permissions)
+
+
+class OfflineAppTestCase(unittest.TestCase):
+    """Runs the app on an in-memory SQLite database, with the token check
+    replaced by one granting every permission.
+    """
+    permissions = frozenset([
+        'get:actors', 'get:movies', 'post:actors', 'post:movies',
+        'patch:actors', 'patch:movies', 'delete:actors', 'delete:movies'])
+
+    def setUp(self):
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                               'QUERY_BUDGET_STRICT': True})
+        self.client = self.app.test_client
+        self.headers = {'Authorization': 'Bearer offline-token'}
+        patcher = mock.patch('auth.verify_token', return_value=VerifiedToken(
+            {'sub': 'offline', 'permissions': sorted(self.permissions)},
+            self.permissions, None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        response_cache.backend.clear()
+        create_schema(self.app)
+
+    def add_actors(self, count):
+        with self.app.app_context():
+            for i in range(count):
+                db.session.add(Actor(name='actor%d' % i, age=20 + i,
+                                     gender='female'))
+            db.session.commit()
+
+    def add_movies(self, count):
+        with self.app.app_context():
+            for i in range(count):
+                db.session.add(Movie(title='movie%d' % i))
+            db.session.commit()
+
+
+class KeysetPaginationTestCase(OfflineAppTestCase):
+    def test_pages_follow_the_cursor(self):
+        self.add_actors(5)
+        res = self.client().get('/actors?limit=2', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['id'] for a in data['actors']], [1, 2])
+        self.assertEqual(data['next_cursor'], 2)
+        self.assertNotIn('total_actors', data)
+
+        res = self.client().get('/actors?limit=2&after=4',
+                                headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual([a['id'] for a in data['actors']], [5])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_total_is_opt_in(self):
+        self.add_movies(3)
+        res = self.client().get('/movies?limit=1&include_total=true',
+                                headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertEqual(data['total_movies'], 3)
+
+    def test_invalid_cursor_is_rejected(self):
+        res = self.client().get('/actors?after=abc', headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class RowCountTestCase(OfflineAppTestCase):
+    def test_totals_follow_inserts_and_deletes(self):
+        self.add_actors(3)
+        res = self.client().delete('/actors/2', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_actors'], 2)
+
+        res = self.client().get('/actors?include_total=1',
+                                headers=self.headers)
+        self.assertEqual(json.loads(res.data)['total_actors'], 2)
+
+    def test_counter_is_seeded_from_existing_rows(self):
+        self.add_movies(2)
+        with self.app.app_context():
+            db.session.query(RowCount).delete()
+            db.session.commit()
+            self.assertEqual(row_count(Movie), 2)
+
+
+class StreamingTestCase(OfflineAppTestCase):
+    def test_stream_returns_every_row(self):
+        self.add_actors(3)
+        with mock.patch('streaming.STREAM_BATCH_SIZE', 2):
+            res = self.client().get('/actors?stream=1&limit=1',
+                                    headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['id'] for a in data['actors']], [1, 2, 3])
+
+    def test_ndjson_is_negotiated(self):
+        self.add_movies(3)
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        res = self.client().get('/movies?after=1', headers=headers)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual([m['id'] for m in rows], [2, 3])
+
+
+class ConditionalGetTestCase(OfflineAppTestCase):
+    def test_unchanged_table_answers_not_modified(self):
+        self.add_actors(2)
+        res = self.client().get('/actors', headers=self.headers)
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+
+        headers = dict(self.headers, **{'If-None-Match': etag})
+        res = self.client().get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+        res = self.client().get('/actors?limit=1', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_writes_change_the_etag(self):
+        self.add_movies(1)
+        res = self.client().get('/movies', headers=self.headers)
+        headers = dict(self.headers, **{'If-None-Match': res.headers['ETag']})
+
+        self.client().post('/movies', json={'title': 'Avengers4'},
+                           headers=self.headers)
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['movies']), 2)
+
+    def test_a_write_creates_a_missing_version_row(self):
+        with self.app.app_context():
+            db.session.query(TableVersion).delete()
+            db.session.commit()
+        res = self.client().post('/movies', json={'title': 'Avengers4'},
+                                 headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            # not left for a reader to seed as 1, the version it had
+            # before the write
+            self.assertEqual(table_version(Movie), 2)
+
+
+class BulkCreateTestCase(OfflineAppTestCase):
+    def test_valid_rows_are_created_and_invalid_reported(self):
+        self.add_actors(2)
+        rows = [{'name': 'a', 'age': 30, 'gender': 'male'},
+                {'name': '', 'age': 30, 'gender': 'male'},
+                {'name': 'c', 'age': 31, 'gender': 'female'}]
+        res = self.client().post('/actors/bulk', json=rows,
+                                 headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], [3, 4])
+        self.assertEqual(data['errors'], [{'index': 1, 'fields': ['name'],
+                                           'message': 'missing or empty fields'
+                                           }])
+        with self.app.app_context():
+            self.assertEqual(row_count(Actor), 4)
+            self.assertEqual(Actor.query.get(4).name, 'c')
+
+    def test_ndjson_body(self):
+        body = '{"title": "a"}\nnot json\n{"title": "b"}\n'
+        res = self.client().post('/movies/bulk', data=body,
+                                 content_type='application/x-ndjson',
+                                 headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['created'], [1, 2])
+        self.assertEqual(data['errors'][0]['index'], 1)
+
+    def test_invalid_utf8_is_a_bad_request(self):
+        for content_type in ('application/x-ndjson', 'application/json'):
+            res = self.client().post('/movies/bulk',
+                                     data=b'{"title": "\xff"}\n',
+                                     content_type=content_type,
+                                     headers=self.headers)
+            self.assertEqual(res.status_code, 400)
+
+    def test_budget_follows_the_number_of_batches(self):
+        rows = [{'title': 'movie%d' % i}
+                for i in range(models.BULK_BATCH_SIZE + 1)]
+        res = self.client().post('/movies/bulk', json=rows,
+                                 headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['created']), len(rows))
+
+    def test_batch_size_is_limited(self):
+        with mock.patch('app.BULK_MAX_ROWS', 1):
+            res = self.client().post('/movies/bulk',
+                                     json=[{'title': 'a'}, {'title': 'b'}],
+                                     headers=self.headers)
+        self.assertEqual(res.status_code, 413)
+
+
+class MutationTestCase(OfflineAppTestCase):
+    def test_patch_returns_only_the_changed_actor(self):
+        self.add_actors(3)
+        res = self.client().patch('/actors/2', json={'age': 99},
+                                  headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'id': 2, 'name': 'actor1',
+                                           'age': 99, 'gender': 'female'}])
+
+    def test_patch_and_delete_unknown_ids(self):
+        res = self.client().patch('/actors/100', json={'age': 99},
+                                  headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().patch('/movies/100', json={'title': 'X-Men'},
+                                  headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().delete('/movies/50', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_mutations_bump_the_version(self):
+        self.add_movies(2)
+        with self.app.app_context():
+            version = table_version(Movie)
+        res = self.client().patch('/movies/1', json={'title': 'X-Men'},
+                                  headers=self.headers)
+        self.assertEqual(json.loads(res.data)['movie'][0]['title'], 'X-Men')
+        res = self.client().delete('/movies/2', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['total_movies'], 1)
+        with self.app.app_context():
+            self.assertEqual(table_version(Movie), version + 2)
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def test_pool_settings_only_apply_to_server_databases(self):
+        options = engine_options('postgres://localhost:5432/example')
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertIn('pool_size', options)
+        self.assertNotIn('pool_size', engine_options('sqlite://'))
+
+    def test_checkout_waits_are_recorded(self):
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0)
+        before = models._pool_waits['count']
+        engine.connect().close()
+        self.assertEqual(models._pool_waits['count'], before + 1)
+
+    def test_only_queueing_counts_as_waiting(self):
+        def slow_connect():
+            time.sleep(0.2)
+            return sqlite3.connect(':memory:')
+
+        engine = create_engine('sqlite://', creator=slow_connect,
+                               poolclass=TimedQueuePool, pool_size=1,
+                               max_overflow=0)
+        with mock.patch.dict(models._pool_waits,
+                             {'count': 0, 'total': 0.0, 'max': 0.0}):
+            held = engine.connect()
+            # opening the connection took 0.2s but nothing was queued
+            self.assertLess(models._pool_waits['max'], 0.1)
+
+            timer = threading.Timer(0.2, held.close)
+            timer.start()
+            engine.connect().close()
+            timer.join()
+            self.assertGreaterEqual(models._pool_waits['max'], 0.15)
+
+            with mock.patch.object(models.db, 'get_engine',
+                                   return_value=engine):
+                stats = models.pool_stats()
+        self.assertEqual(stats['pool'], 'TimedQueuePool')
+        self.assertEqual(stats['wait_count'], 2)
+        self.assertGreaterEqual(stats['wait_seconds_max'], 0.15)
+        self.assertEqual((stats['size'], stats['checked_in'],
+                          stats['checked_out']), (1, 1, 0))
+
+
+class ReplicaRoutingTestCase(OfflineAppTestCase):
+    """A second SQLite file stands in for the replica; nothing copies the
+    primary to it, so the tests can tell which one answered.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        primary = os.path.join(self.tmp.name, 'primary.db')
+        replica = os.path.join(self.tmp.name, 'replica.db')
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + primary,
+            'DATABASE_REPLICA_URLS': ['sqlite:///' + replica]})
+        create_schema(self.app)
+        shutil.copyfile(primary, replica)
+        self.client = self.app.test_client
+        self.headers = {'Authorization': 'Bearer offline-token'}
+        patcher = mock.patch('auth.verify_token', return_value=VerifiedToken(
+            {'sub': 'offline', 'permissions': sorted(self.permissions)},
+            self.permissions, None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        response_cache.backend.clear()
+        with self.app.app_context():
+            db.get_engine(bind='replica0').execute(
+                Actor.__table__.insert(), name='on replica', age=30,
+                gender='male')
+
+    def test_reads_go_to_the_replica(self):
+        self.add_actors(2)
+        res = self.client().get('/actors', headers=self.headers)
+        names = [a['name'] for a in json.loads(res.data)['actors']]
+        self.assertEqual(names, ['on replica'])
+
+    def test_writes_go_to_the_primary(self):
+        res = self.client().post('/actors', json={'name': 'new', 'age': 1,
+                                                  'gender': 'male'},
+                                 headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual([a.name for a in Actor.query.all()], ['new'])
+
+
+class ResponseCacheTestCase(OfflineAppTestCase):
+    def test_repeated_reads_are_served_from_cache(self):
+        self.add_actors(2)
+        before = response_cache.stats()
+        first = self.client().get('/actors', headers=self.headers)
+        with mock.patch('app.keyset_page') as keyset_page:
+            second = self.client().get('/actors', headers=self.headers)
+        self.assertFalse(keyset_page.called)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(response_cache.stats()['hits'], before['hits'] + 1)
+
+    def test_writes_invalidate_cached_lists(self):
+        self.add_movies(1)
+        self.client().get('/movies', headers=self.headers)
+        self.client().post('/movies', json={'title': 'Avengers4'},
+                           headers=self.headers)
+        self.assertEqual(response_cache.stats()['size'], 0)
+        res = self.client().get('/movies', headers=self.headers)
+        self.assertEqual(len(json.loads(res.data)['movies']), 2)
+
+    def test_memory_backend_evicts_and_expires(self):
+        now = [0]
+        backend = MemoryBackend(maxsize=2, ttl=10, clock=lambda: now[0])
+        backend.set(('actors', 1), 'a')
+        backend.set(('actors', 2), 'b')
+        backend.get(('actors', 1))
+        backend.set(('movies', 1), 'c')
+        self.assertIsNone(backend.get(('actors', 2)))
+        self.assertEqual(backend.get(('actors', 1)), 'a')
+        now[0] = 10
+        self.assertIsNone(backend.get(('movies', 1)))
+        self.assertEqual(backend.stats()['evictions'], 1)
+
+
+class FilterTestCase(OfflineAppTestCase):
+    def test_actor_filters(self):
+        self.add_actors(5)
+        res = self.client().get('/actors?age_min=21&age_max=23',
+                                headers=self.headers)
+        ages = [a['age'] for a in json.loads(res.data)['actors']]
+        self.assertEqual(ages, [21, 22, 23])
+
+        res = self.client().get('/actors?name=actor4&gender=female',
+                                headers=self.headers)
+        names = [a['name'] for a in json.loads(res.data)['actors']]
+        self.assertEqual(names, ['actor4'])
+
+        res = self.client().get('/actors?name=Actor', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['actors'], [])
+
+    def test_release_date_range(self):
+        with self.app.app_context():
+            for year in (2018, 2019, 2020):
+                movie = Movie(title=str(year))
+                movie.release_date = datetime(year, 5, 1)
+                db.session.add(movie)
+            db.session.commit()
+        res = self.client().get(
+            '/movies?released_after=2019-01-01&released_before=2020-05-01',
+            headers=self.headers)
+        titles = [m['title'] for m in json.loads(res.data)['movies']]
+        self.assertEqual(titles, ['2019'])
+
+    def test_invalid_filter_is_rejected(self):
+        res = self.client().get('/movies?released_after=someday',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class SearchTestCase(OfflineAppTestCase):
+    def search(self, q):
+        res = self.client().get('/search?q=' + q, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_matches_actors_and_movies(self):
+        self.client().post('/actors', json={'name': 'Tom Hanks', 'age': 60,
+                                            'gender': 'male'},
+                           headers=self.headers)
+        self.client().post('/movies/bulk', json=[{'title': 'Tom and Jerry'},
+                                                 {'title': 'Titanic'}],
+                           headers=self.headers)
+        data = self.search('tom')
+        found = sorted((hit['type'], hit[hit['type']]['id'])
+                       for hit in data['results'])
+        self.assertEqual(found, [('actor', 1), ('movie', 1)])
+        self.assertEqual(len(self.search('tit')['results']), 1)
+
+    def test_index_follows_updates_and_deletes(self):
+        self.add_movies(2)
+        self.client().patch('/movies/1', json={'title': 'Casablanca'},
+                            headers=self.headers)
+        self.assertEqual(self.search('movie0')['results'], [])
+        self.assertEqual(len(self.search('casablanca')['results']), 1)
+        self.client().delete('/movies/1', headers=self.headers)
+        self.assertEqual(self.search('casablanca')['results'], [])
+
+    def test_results_are_paginated(self):
+        self.add_actors(3)
+        data = self.search('actor&limit=2')
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(data['next_offset'], 2)
+        data = self.search('actor&limit=2&offset=2')
+        self.assertEqual(len(data['results']), 1)
+        self.assertIsNone(data['next_offset'])
+
+
+class CastingTestCase(OfflineAppTestCase):
+    def cast(self, movie_id, actor_ids):
+        for actor_id in actor_ids:
+            res = self.client().post('/movies/%d/actors' % movie_id,
+                                     json={'actor_id': actor_id},
+                                     headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+
+    def count_queries(self, path):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get(path, headers=self.headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(res.status_code, 200)
+        return len(statements), json.loads(res.data)
+
+    def test_cast_and_filmography(self):
+        self.add_actors(3)
+        self.add_movies(2)
+        self.cast(1, [3, 1])
+        self.cast(2, [1])
+        data = json.loads(self.client().get('/movies/1/actors',
+                                            headers=self.headers).data)
+        self.assertEqual([a['id'] for a in data['actors']], [1, 3])
+        data = json.loads(self.client().get('/actors/1/movies',
+                                            headers=self.headers).data)
+        self.assertEqual([m['id'] for m in data['movies']], [1, 2])
+
+        res = self.client().delete('/movies/1/actors/3', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete('/movies/1/actors/3', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        self.client().delete('/actors/1', headers=self.headers)
+        data = json.loads(self.client().get('/movies/1/actors',
+                                            headers=self.headers).data)
+        self.assertEqual(data['actors'], [])
+
+    def test_deleting_the_parent_invalidates_the_nested_list(self):
+        self.add_movies(1)
+        res = self.client().get('/movies/1/actors', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        headers = dict(self.headers, **{'If-None-Match': res.headers['ETag']})
+
+        self.client().delete('/movies/1', headers=self.headers)
+        res = self.client().get('/movies/1/actors', headers=headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get('/movies/1/actors', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_unknown_ids(self):
+        self.add_actors(1)
+        res = self.client().get('/movies/9/actors', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().post('/movies/9/actors', json={'actor_id': 1},
+                                 headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().post('/movies/1/actors', json={'actor_id': True},
+                                 headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/actors?include=awards',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_include_with_total_stays_within_budget(self):
+        self.add_actors(2)
+        self.add_movies(2)
+        self.cast(1, [1, 2])
+        for path in ('/actors?include=movies&include_total=1',
+                     '/movies?include=actors&include_total=1'):
+            res = self.client().get(path, headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+
+    def test_include_runs_a_fixed_number_of_queries(self):
+        self.add_actors(2)
+        self.add_movies(2)
+        self.cast(1, [1, 2])
+        few, data = self.count_queries('/movies?include=actors')
+        self.assertEqual([a['id'] for a in data['movies'][0]['actors']],
+                         [1, 2])
+        self.assertEqual(data['movies'][1]['actors'], [])
+
+        self.add_movies(20)
+        response_cache.backend.clear()
+        many, data = self.count_queries('/movies?include=actors')
+        self.assertEqual(len(data['movies']), 22)
+        self.assertEqual(few, many)
+
+    def test_casting_changes_the_included_lists(self):
+        self.add_actors(1)
+        self.add_movies(1)
+        res = self.client().get('/actors?include=movies',
+                                headers=self.headers)
+        self.assertEqual(json.loads(res.data)['actors'][0]['movies'], [])
+        self.cast(1, [1])
+        res = self.client().get('/actors?include=movies',
+                                headers={**self.headers,
+                                         'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [m['id'] for m in json.loads(res.data)['actors'][0]['movies']],
+            [1])
+
+
+class SparseFieldsTestCase(OfflineAppTestCase):
+    def test_only_the_selected_columns_are_read(self):
+        self.add_actors(3)
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get('/actors?fields=name&limit=2',
+                                    headers=self.headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'id': 1, 'name': 'actor0'},
+                                          {'id': 2, 'name': 'actor1'}])
+        self.assertEqual(data['next_cursor'], 2)
+        select = [s for s in statements if 'FROM actors' in s][-1]
+        self.assertNotIn('actors.age', select)
+        self.assertNotIn('actors.gender', select)
+
+    def test_detail_endpoints(self):
+        self.add_movies(1)
+        res = self.client().get('/movies/1?fields=title',
+                                headers=self.headers)
+        self.assertEqual(json.loads(res.data)['movie'],
+                         {'id': 1, 'title': 'movie0'})
+        res = self.client().get('/movies/1', headers=self.headers)
+        self.assertIn('release_date', json.loads(res.data)['movie'])
+        res = self.client().get('/movies/2', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_fields_compose_with_stream_and_include(self):
+        self.add_actors(2)
+        self.add_movies(1)
+        self.client().post('/movies/1/actors', json={'actor_id': 2},
+                           headers=self.headers)
+        res = self.client().get('/actors?fields=age',
+                                headers={**self.headers,
+                                         'Accept': 'application/x-ndjson'})
+        self.assertEqual([json.loads(line) for line in res.data.splitlines()],
+                         [{'id': 1, 'age': 20}, {'id': 2, 'age': 21}])
+        res = self.client().get('/movies?fields=title&include=actors',
+                                headers=self.headers)
+        movie = json.loads(res.data)['movies'][0]
+        self.assertEqual(sorted(movie), ['actors', 'id', 'title'])
+        self.assertEqual([a['id'] for a in movie['actors']], [2])
+
+    def test_unknown_fields_are_rejected(self):
+        for path in ('/actors?fields=name,salary', '/actors/1?fields=',
+                     '/movies?fields=actor_in_movies'):
+            res = self.client().get(path, headers=self.headers)
+            self.assertEqual(res.status_code, 400)
+
+
+class ReadPathTestCase(OfflineAppTestCase):
+    def test_core_rows_format_like_the_models(self):
+        self.add_actors(3)
+        self.add_movies(3)
+        with self.app.app_context():
+            for model in (Actor, Movie):
+                fields = models.model_fields(model)
+                rows = models.read_rows(
+                    models.select_rows(model, fields)).fetchall()
+                self.assertEqual(
+                    [models.format_row(row, fields) for row in rows],
+                    [row.format() for row in model.query.order_by(model.id)])
+
+    def test_list_reads_do_not_build_instances(self):
+        self.add_actors(3)
+        loads = []
+
+        def record(target, context):
+            loads.append(target)
+
+        event.listen(Actor, 'load', record)
+        try:
+            res = self.client().get('/actors', headers=self.headers)
+            self.client().get('/actors?stream=1', headers=self.headers)
+        finally:
+            event.remove(Actor, 'load', record)
+        self.assertEqual(len(json.loads(res.data)['actors']), 3)
+        self.assertEqual(loads, [])
+
+
+class SerializerTestCase(OfflineAppTestCase):
+    def test_release_date_is_iso_8601(self):
+        with self.app.app_context():
+            movie = Movie(title='Metropolis')
+            movie.release_date = datetime(1927, 1, 10, 20, 30)
+            db.session.add(movie)
+            db.session.commit()
+        res = self.client().get('/movies/1', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['movie']['release_date'],
+                         '1927-01-10T20:30:00.000000Z')
+        for value, count in [('1927-01-10T20:30:00.000000Z', 1),
+                             ('1927-01-10T21:30:00%2B01:00', 1),
+                             ('1927-01-10T20:30:00.000001Z', 0)]:
+            res = self.client().get('/movies?released_after=' + value,
+                                    headers=self.headers)
+            self.assertEqual(len(json.loads(res.data)['movies']), count)
+
+    def test_output_is_byte_stable(self):
+        document = {'title': 'Amélie', 'id': 3, 'tags': ['a', None, True],
+                    'nested': {'b': 1, 'a': '"\\n'}}
+        encoded = serializers.dumps_stdlib(document)
+        self.assertEqual(encoded, serializers.dumps_stdlib(dict(
+            reversed(list(document.items())))))
+        self.assertEqual(json.loads(encoded.decode('utf-8')), document)
+        if serializers.orjson is not None:
+            self.assertEqual(serializers.dumps_orjson(document), encoded)
+
+    def test_serializers_are_built_once(self):
+        self.assertIs(serializers.serializer(Actor, ['id', 'name']),
+                      serializers.serializer(Actor, ('id', 'name')))
+        self.assertIs(serializers.serializer(Movie),
+                      serializers.serializer(Movie, models.model_fields(
+                          Movie)))
+
+
+@unittest.skipIf(asgi is None or not asyncdb.supported('sqlite:///x.db'),
+                 'uvicorn and aiosqlite are not installed')
+class ASGITestCase(OfflineAppTestCase):
+    """Compares the async handlers of asgi.py with the Flask routes on
+    the same SQLite file."""
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        url = 'sqlite:///' + os.path.join(directory, 'casting.db')
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': url})
+        create_schema(self.app)
+        self.client = self.app.test_client
+        self.headers = {'Authorization': 'Bearer offline-token'}
+        verified = VerifiedToken(
+            {'sub': 'offline', 'permissions': sorted(self.permissions)},
+            self.permissions, None)
+        database = asyncdb.AsyncDatabase(url)
+        for patcher in (
+                mock.patch('auth.verify_token', return_value=verified),
+                mock.patch('asgi.verify', mock.AsyncMock(
+                    return_value=verified)),
+                mock.patch('asgi.flask_app', self.app),
+                mock.patch('asgi.wsgi', asgi.WSGIMiddleware(self.app)),
+                mock.patch('asyncdb.primary', database),
+                mock.patch('asyncdb.reader', return_value=database)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.database = database
+        response_cache.backend.clear()
+
+    def get(self, path, query_string=b'', headers=()):
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'query_string': query_string, 'http_version': '1.1',
+                 'root_path': '', 'server': ('localhost', 80),
+                 'headers': [(b'host', b'localhost'),
+                             (b'authorization', b'Bearer offline-token')] +
+                 list(headers)}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        async def call():
+            try:
+                await asgi.app(scope, receive, send)
+            finally:
+                await self.database.close()
+
+        asyncio.run(call())
+        return (messages[0]['status'], dict(messages[0]['headers']),
+                b''.join(message.get('body', b'')
+                         for message in messages[1:]))
+
+    def test_async_handlers_answer_like_flask(self):
+        self.add_actors(3)
+        self.add_movies(2)
+        for path, query_string in [
+                ('/actors', b'limit=2&include_total=true'),
+                ('/actors', b'gender=female&fields=name'),
+                ('/movies', b''), ('/movies/2', b''), ('/movies/7', b''),
+                ('/actors', b'limit=zero'), ('/actors', b'include=movies')]:
+            status, headers, body = self.get(path, query_string)
+            res = self.client().get(path + '?' + query_string.decode(),
+                                    headers=self.headers)
+            self.assertEqual((status, body), (res.status_code, res.data))
+            if status == 200 and b'include' not in query_string:
+                self.assertEqual(headers[b'etag'].decode(),
+                                 res.headers['ETag'])
+
+    def test_not_modified_and_auth_errors(self):
+        self.add_actors(1)
+        status, headers, body = self.get('/actors')
+        status, headers, body = self.get('/actors', headers=[
+            (b'if-none-match', headers[b'etag'])])
+        self.assertEqual((status, body), (304, b''))
+        self.assertIn(b'Accept-Encoding', headers[b'vary'])
+
+        scope_headers = [(b'authorization', b'Basic abc')]
+        with mock.patch('asgi.verify', side_effect=AssertionError):
+            status, _, body = self.get('/actors', headers=scope_headers)
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(body)['code'], 'invalid_header')
+
+    def test_token_is_checked_before_the_parameters(self):
+        expired = AuthError({'code': 'token_expired',
+                             'description': 'Token expired.'}, 401)
+        unauthorized = VerifiedToken({'sub': 'offline', 'permissions': []},
+                                     frozenset(), None)
+        for patch in ({'side_effect': expired},
+                      {'return_value': unauthorized}):
+            with mock.patch('asgi.verify', mock.AsyncMock(**patch)), \
+                    mock.patch('auth.verify_token', **patch):
+                for path, query_string in [
+                        ('/actors', b'limit=abc'),
+                        ('/actors', b'fields=salary'),
+                        ('/movies', b'released_after=x'),
+                        ('/actors', b'include=awards'),
+                        ('/movies/1', b'fields=salary')]:
+                    status, _, body = self.get(path, query_string)
+                    res = self.client().get(
+                        path + '?' + query_string.decode(),
+                        headers=self.headers)
+                    self.assertIn(status, (401, 403))
+                    self.assertEqual((status, body),
+                                     (res.status_code, res.data))
+
+
+class MetricsTestCase(OfflineAppTestCase):
+    def test_requests_are_timed_by_route(self):
+        self.add_actors(1)
+        labels = ('/actors/<int:actor_id>', 'GET')
+        before = metrics.registry.counters.get(
+            ('http_requests_total', labels + (200,)), 0)
+        res = self.client().get('/actors/1', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(metrics.registry.counters[
+            ('http_requests_total', labels + (200,))], before + 1)
+        for name in ('http_request_auth_seconds', 'http_request_db_seconds'):
+            self.assertGreater(
+                metrics.registry.histograms[(name, labels)][-1], 0)
+        self.assertIn(('db_query_duration_seconds', labels[:1]),
+                      metrics.registry.histograms)
+
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        text = res.get_data(as_text=True)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_requests_total{route="/actors/<int:actor_id>",'
+                      'method="GET",status="200"} %d' % (before + 1), text)
+        self.assertIn('http_request_db_seconds_bucket{route="/actors/'
+                      '<int:actor_id>",method="GET",le="+Inf"}', text)
+
+    def test_workers_are_added_up(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(metrics, 'METRICS_DIR', directory):
+            other = metrics.Registry()
+            other.inc('http_requests_total', ('/actors', 'GET', 200), 5)
+            other.observe('http_request_duration_seconds',
+                          ('/actors', 'GET'), 0.002)
+            metrics._write(metrics._worker_file(1), other.snapshot())
+            own = metrics.registry.counters.get(
+                ('http_requests_total', ('/actors', 'GET', 200)), 0)
+
+            total = metrics.collect()
+            self.assertEqual(total.counters[
+                ('http_requests_total', ('/actors', 'GET', 200))], own + 5)
+
+            # an exited worker's totals stay in the archive
+            metrics.retire_worker(1)
+            self.assertFalse(os.path.exists(metrics._worker_file(1)))
+            total = metrics.collect()
+            self.assertEqual(total.counters[
+                ('http_requests_total', ('/actors', 'GET', 200))], own + 5)
+
+
+class QueryLogTestCase(OfflineAppTestCase):
+    def test_shapes_ignore_literals_and_list_lengths(self):
+        self.assertEqual(
+            querylog.normalize('SELECT a FROM t\n WHERE id IN (?, ?, ?)'),
+            querylog.normalize("SELECT a FROM t WHERE id IN (?)"))
+        self.assertEqual(querylog.normalize("SELECT 1 WHERE name = 'x'"),
+                         'SELECT ? WHERE name = ?')
+
+    def test_requests_are_counted(self):
+        self.add_actors(1)
+        seen = []
+        self.app.after_request(lambda response: seen.append(
+            querylog.stats().statements) or response)
+        res = self.client().get('/actors/1', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(seen, [2])
+
+    def test_repeated_statements_are_flagged(self):
+        @self.app.route('/loop')
+        def loop():
+            for i in range(querylog.N_PLUS_ONE_THRESHOLD):
+                Actor.query.get(i)
+            return 'ok'
+
+        with self.assertLogs('querylog', 'WARNING') as logs:
+            self.client().get('/loop')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('possible N+1 on /loop', logs.output[0])
+
+    def test_slow_queries_are_logged(self):
+        self.add_actors(1)
+        with mock.patch.object(querylog, 'SLOW_QUERY_MS', 0), \
+                self.assertLogs('querylog', 'WARNING') as logs:
+            self.client().get('/actors/1', headers=self.headers)
+        self.assertIn('on /actors/<int:actor_id>: SELECT', logs.output[0])
+
+    def test_over_budget_fails_the_request(self):
+        @self.app.route('/expensive')
+        @querylog.query_budget(1)
+        def expensive():
+            Actor.query.all()
+            Movie.query.all()
+            return 'ok'
+
+        res = self.client().get('/expensive')
+        self.assertEqual(res.status_code, 500)
+
+        self.app.config['QUERY_BUDGET_STRICT'] = False
+        with self.assertLogs('querylog', 'WARNING') as logs:
+            res = self.client().get('/expensive')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('ran 2 statements, over its budget of 1',
+                      logs.output[0])
+
+
+class StartupTestCase(unittest.TestCase):
+    def test_create_app_does_not_touch_the_database(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'casting.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path})
+        self.assertFalse(os.path.exists(path))
+
+        create_schema(app)
+        with app.app_context():
+            self.assertEqual(row_count(Actor), 0)
+            self.assertEqual(Movie.query.count(), 0)
+
+    def test_warm_up_loads_the_keys(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        with mock.patch('auth.jwks_store.refresh') as refresh:
+            warm_up(app)
+        refresh.assert_called_once_with()
+
+        # an unreachable key server leaves it to the first request
+        with mock.patch('auth.jwks_store.refresh', side_effect=AuthError(
+                {'code': 'jwks_unavailable'}, 503)):
+            warm_up(app)
+
+    def test_key_store_keeps_its_keys_after_fork(self):
+        store = JWKSKeyStore('https://example.com/jwks.json', fetch=lambda: {
+            'keys': [{'kty': 'RSA', 'kid': 'k', 'n': 'n', 'e': 'e'}]})
+        store.refresh()
+        lock = store._refresh_lock
+        store.after_fork()
+        self.assertIsNot(store._refresh_lock, lock)
+        self.assertEqual(store.get_key('k')['n'], 'n')
+
+
+class GroupCommitTestCase(OfflineAppTestCase):
+    def setUp(self):
+        super().setUp()
+        # a file, as the writer thread has a connection of its own
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                directory, 'casting.db'),
+            'GROUP_COMMIT': True, 'QUERY_BUDGET_STRICT': True})
+        self.client = self.app.test_client
+        create_schema(self.app)
+        self.writer = self.app.extensions['group_commit']
+
+    def insert_concurrently(self, rows):
+        results = {}
+
+        def insert(i):
+            try:
+                results[i] = self.writer.insert(Actor, rows[i])
+            except Exception as error:
+                results[i] = error
+
+        threads = [threading.Thread(target=insert, args=(i,))
+                   for i in range(len(rows))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_inserts_share_a_commit(self):
+        commits = []
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'commit', commits.append)
+        self.writer.window = 0.5
+        self.writer.max_rows = 8
+
+        results = self.insert_concurrently([
+            {'name': 'actor%d' % i, 'age': 20 + i, 'gender': 'female'}
+            for i in range(8)])
+        self.assertEqual(len(commits), 1)
+        with self.app.app_context():
+            self.assertEqual(row_count(Actor), 8)
+            self.assertEqual(table_version(Actor), 2)
+            for i, id in results.items():
+                self.assertEqual(Actor.query.get(id).name, 'actor%d' % i)
+
+    def test_a_failing_row_only_fails_its_caller(self):
+        self.writer.window = 0.5
+        self.writer.max_rows = 4
+        rows = [{'name': 'actor%d' % i, 'age': 20 + i, 'gender': 'female'}
+                for i in range(4)]
+        rows[2]['name'] = None
+        results = self.insert_concurrently(rows)
+        self.assertIsInstance(results.pop(2), exc.IntegrityError)
+        with self.app.app_context():
+            self.assertEqual(row_count(Actor), 3)
+            self.assertEqual(sorted(a.name for a in Actor.query.all()),
+                             ['actor0', 'actor1', 'actor3'])
+
+    def test_post_returns_the_committed_id(self):
+        res = self.client().post('/movies', json={'title': 'grouped'},
+                                 headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        created = json.loads(res.data)['created']
+        with self.app.app_context():
+            self.assertEqual(Movie.query.get(created).title, 'grouped')
+
+
+class ImportTestCase(OfflineAppTestCase):
+    def write(self, name, text):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_csv_rows_are_checked_like_the_api(self):
+        path = self.write('actors.csv', 'name,age,gender,extra\n'
+                          'ana,31,female,x\n'
+                          ',40,male,x\n'
+                          'bo,old,male,x\n'
+                          'cy,52,male,x\n')
+        with self.app.app_context():
+            imported, errors, seconds = importer.import_file(
+                'actors', path, batch_size=1, defer_indexes=True)
+            self.assertEqual(imported, 2)
+            self.assertEqual(errors, [
+                (3, 'missing or empty fields: name'),
+                (4, "invalid age: 'old'")])
+            self.assertEqual([(a.name, a.age) for a in Actor.query.all()],
+                             [('ana', 31), ('cy', 52)])
+            self.assertEqual(row_count(Actor), 2)
+            self.assertEqual(table_version(Actor), 2)
+            # the indexes are back
+            self.assertEqual(
+                len(importer.secondary_indexes(db.session.connection(),
+                                               Actor.__table__)), 3)
+        res = self.client().get('/search?q=cy', headers=self.headers)
+        self.assertEqual(len(json.loads(res.data)['results']), 1)
+
+    def test_defer_indexes_needs_an_empty_table(self):
+        self.add_actors(1)
+        path = self.write('actors.csv', 'name,age,gender\nana,31,female\n')
+        with self.app.app_context():
+            with self.assertRaises(importer.ImportRefused):
+                importer.import_file('actors', path, defer_indexes=True)
+            self.assertEqual(row_count(Actor), 1)
+            self.assertEqual(
+                len(importer.secondary_indexes(db.session.connection(),
+                                               Actor.__table__)), 3)
+
+    def test_ndjson_movies_get_a_release_date(self):
+        path = self.write('movies.ndjson', '{"title": "heat"}\n'
+                          'not json\n'
+                          '\n'
+                          '{"title": "ran", "release_date": "ignored"}\n')
+        with self.app.app_context():
+            imported, errors, seconds = importer.import_file('movies', path)
+            self.assertEqual(imported, 2)
+            self.assertEqual(errors, [(2, 'invalid JSON object')])
+            for movie in Movie.query.all():
+                self.assertIsInstance(movie.release_date, datetime)
+
+
+class CompressionTestCase(OfflineAppTestCase):
+    def get(self, url, encoding, **headers):
+        headers = dict(self.headers, **headers)
+        headers['Accept-Encoding'] = encoding
+        return self.client().get(url, headers=headers)
+
+    def test_large_responses_are_gzipped(self):
+        self.add_actors(3)
+        with mock.patch('compression.COMPRESSION_MIN_SIZE', 100):
+            res = self.get('/actors', 'gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        data = json.loads(zlib.decompress(res.data, 31))
+        self.assertEqual(len(data['actors']), 3)
+
+    def test_small_responses_are_not_compressed(self):
+        self.add_actors(1)
+        res = self.get('/actors', 'gzip')
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(len(json.loads(res.data)['actors']), 1)
+
+    def test_streams_are_compressed_chunk_by_chunk(self):
+        self.add_actors(3)
+        with mock.patch('streaming.STREAM_BATCH_SIZE', 1):
+            res = self.get('/actors?stream=1', 'gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', res.headers)
+        data = json.loads(zlib.decompress(res.data, 31))
+        self.assertEqual([a['id'] for a in data['actors']], [1, 2, 3])
+
+    def test_cache_stores_the_compressed_body(self):
+        self.add_movies(3)
+        with mock.patch('compression.COMPRESSION_MIN_SIZE', 100):
+            first = self.get('/movies', 'gzip')
+            with mock.patch('compression.compress_body') as compress_body:
+                second = self.get('/movies', 'gzip')
+            identity = self.get('/movies', 'identity')
+        self.assertFalse(compress_body.called)
+        self.assertEqual(second.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(first.data, second.data)
+        self.assertNotIn('Content-Encoding', identity.headers)
+        self.assertEqual(json.loads(identity.data),
+                         json.loads(zlib.decompress(second.data, 31)))
+        self.assertNotEqual(first.headers['ETag'], identity.headers['ETag'])
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli_is_preferred(self):
+        self.add_actors(3)
+        with mock.patch('compression.COMPRESSION_MIN_SIZE', 100):
+            res = self.get('/actors', 'gzip, br')
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        data = json.loads(compression.brotli.decompress(res.data))
+        self.assertEqual(len(data['actors']), 3)
+
+
+class ManageTestCase(unittest.TestCase):
+    def test_manage_registers_its_commands(self):
+        import manage
+        self.assertEqual(
+            sorted(name for name in manage.manager._commands
+                   if name in ('create_db', 'db', 'import')),
+            ['create_db', 'db', 'import'])
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
   unittest.main()
\ No newline at end of file
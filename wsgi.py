@@ -0,0 +1,13 @@
+from app import create_app
+
+'''
+WSGI entry point
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Importing app.py only defines create_app; the app is built here, for the
+server. The schema is not touched: create it with
+python manage.py create_db or python manage.py db upgrade.
+'''
+
+app = create_app()